@@ -98,17 +98,31 @@ del __virtualenv
 # ==============================================================================
 
 import asyncio
+import bisect
+import codecs
+import collections
+import contextlib
+import dataclasses
+import datetime
+import errno
+import hashlib
+import heapq
+import html
+import html.parser
+import itertools
 import json
 import os.path
+import random
 import re
+import sqlite3
 import sys
 import time
+import urllib.parse
 
-import aiofiles
 import aiohttp
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString
 from icecream import ic
-from playwright.async_api import async_playwright, BrowserContext, BrowserType
+from playwright.async_api import async_playwright, BrowserContext, BrowserType, Page
 from playwright_stealth import stealth_async
 import yaml
 
@@ -119,67 +133,555 @@ def yaml_load (path:str) -> dict:
 		data = yaml.load (file, Loader = yaml.loader.SafeLoader)
 		return data
 
-# ==============================================================================
+CONFIG_DEFAULTS = {
+	"reload": 5,
+	"discord": {
+		"delivery": {
+			"outbox": "outbox.log",
+			"retries": 5,
+			"backoff": 1,
+			"cooldown": 60,
+		},
+	},
+	"vxtwitter": {
+		"enabled": True,
+		"cache_size": 1024,
+		"cache_ttl": 3600,
+	},
+	"http": {
+		"limit": 100,
+		"limit_per_host": 10,
+		"dns_cache": 300,
+		"keepalive": 60,
+		"timeout": 30,
+		"connect_timeout": 10,
+	},
+	"playwright": {
+		"concurrency": 4,
+		"block": {
+			"resources": ["image", "media", "font"],
+			"hosts": [
+				"ads-api.twitter.com",
+				"ads-api.x.com",
+				"ads-twitter.com",
+				"analytics.twitter.com",
+				"doubleclick.net",
+				"google-analytics.com",
+				"googletagmanager.com",
+			],
+			"report": False,
+		},
+	},
+	"twitter": {
+		"delays": {
+			"login_check": 900,
+			"render": 3,
+			"jitter": 5,
+			"rate_limit": 900,
+		},
+		"parser": "evaluate",
+		"incremental": 3,
+		"logins": [],
+	},
+	"history": {
+		"backend": "log",
+		"path": "history.log",
+		"import": "history.json",
+		"retention": {
+			"count": None,
+			"ttl": 0,
+		},
+		"refresh": 3600,
+		"compaction": 3600,
+	},
+}
+
+def config_merge_defaults (config:dict, defaults:dict) -> dict:
+	# Fill in anything missing from the configuration so older config.yaml
+	# files keep working as new settings are added
+	for key, value in defaults.items ():
+		if isinstance (value, dict):
+			if not isinstance (config.get (key), dict):
+				config [key] = {}
+			config_merge_defaults (config [key], value)
+
+		elif key not in config:
+			config [key] = value
+
+	return config
+
+def config_compile (config:dict) -> dict:
+	# Work out everything derived from the configuration up front, instead of
+	# on every check
+	for watch in config ["watches"]:
+		watch ["template"] = discord_embed_template (config, watch)
+
+		for settings in watch ["accounts"].values ():
+			settings ["filter"] = tweet_filter_mask (settings)
+
+	return config
+
+def config_load (path:str) -> dict:
+	return config_compile (config_merge_defaults (yaml_load (path), CONFIG_DEFAULTS))
+
+class TTLCache:
+	# Least recently used cache whose entries also expire after ttl seconds
+
+	def __init__ (self, size:int, ttl:float):
+		self.size = size
+		self.ttl = ttl
+		# key -> (expires, value), least recently used first
+		self.entries = collections.OrderedDict ()
+
+	def get (self, key) -> tuple:
+		# Returns (found, value) so None can be cached too
+		entry = self.entries.get (key)
+		if entry is None:
+			return False, None
+
+		if entry [0] <= time.monotonic ():
+			del self.entries [key]
+			return False, None
+
+		self.entries.move_to_end (key)
+		return True, entry [1]
+
+	def set (self, key, value):
+		self.entries [key] = (time.monotonic () + self.ttl, value)
+		self.entries.move_to_end (key)
+
+		while len (self.entries) > self.size:
+			self.entries.popitem (last = False)
+
+def atomic_write (path:str, contents:str):
+	# Write to a temporary file and rename it over the original so a crash
+	# leaves either the old or the new contents, never a mix
+	temp_path = f"{path}.tmp"
+
+	with open (temp_path, "w", encoding = "utf-8") as fh:
+		fh.write (contents)
+		fh.flush ()
+		os.fsync (fh.fileno ())
 
-async def twitter_login (context:BrowserContext, username:str, password:str) -> bool:
 	try:
-		page = await context.new_page ()
+		os.replace (temp_path, path)
+
+	except OSError as error:
+		# Files bind-mounted into a container can't be renamed over, so fall
+		# back to rewriting in place
+		if error.errno not in (errno.EBUSY, errno.EXDEV):
+			raise
+
+		os.remove (temp_path)
+		with open (path, "w", encoding = "utf-8") as fh:
+			fh.write (contents)
+			fh.flush ()
+			os.fsync (fh.fileno ())
+
+def truncate_torn (path:str):
+	# Cut an append-only log back to its last complete line. A crash mid-write
+	# leaves a fragment without a newline, and appending straight onto it
+	# would turn the next line into garbage as well
+	with open (path, "rb+") as fh:
+		size = fh.seek (0, os.SEEK_END)
+		if size == 0:
+			return
+
+		fh.seek (size - 1)
+		if fh.read (1) == b"\n":
+			return
+
+		# Look backwards for the end of the last complete line
+		position = size
+		while position > 0:
+			start = max (0, position - 65536)
+			fh.seek (start)
+			newline = fh.read (position - start).rfind (b"\n")
+			if newline != -1:
+				fh.truncate (start + newline + 1)
+				return
+			position = start
+
+		fh.truncate (0)
+
+# ==============================================================================
+
+class ResourceBlocker:
+	# Aborts heavy resource types and tracking hosts for every page in a
+	# context, keeping per-page counts of what was blocked and loaded
+
+	def __init__ (self, resources:list[str], hosts:list[str], counting:bool = False):
+		self.resources = set (resources)
+		self.hosts = tuple (hosts)
+		# Whether to keep the stats below and report them after each scrape
+		self.counting = counting
+		# page -> {"blocked": {resource type: count}, "loaded": bytes}
+		self.stats = {}
+
+	async def attach (self, context:BrowserContext):
+		# Routing every request has a cost, so only do it if there's something
+		# to block
+		if len (self.resources) != 0 or len (self.hosts) != 0:
+			await context.route ("**/*", self.route)
+
+		if self.counting is True:
+			context.on ("response", self.response)
+
+	def page_stats (self, page:Page) -> dict:
+		if page not in self.stats:
+			self.stats [page] = {"blocked": {}, "loaded": 0}
+		return self.stats [page]
+
+	def blocked_host (self, url:str) -> bool:
+		host = urllib.parse.urlsplit (url).hostname or ""
+		return any (host == blocked or host.endswith (f".{blocked}") for blocked in self.hosts)
+
+	async def route (self, route):
+		request = route.request
+
+		if request.resource_type in self.resources or self.blocked_host (request.url) is True:
+			if self.counting is True:
+				try:
+					blocked = self.page_stats (request.frame.page) ["blocked"]
+					blocked [request.resource_type] = blocked.get (request.resource_type, 0) + 1
+				except Exception:
+					# Requests from workers don't belong to a page
+					pass
+
+			await route.abort ("blockedbyclient")
+
+		else:
+			await route.continue_ ()
+
+	def response (self, response):
+		if self.counting is False:
+			return
+
+		try:
+			self.page_stats (response.frame.page) ["loaded"] += int (response.headers.get ("content-length", 0))
+		except Exception:
+			pass
+
+	def reset (self, page:Page):
+		self.stats.pop (page, None)
+
+	def report (self, page:Page, label:str):
+		stats = self.stats.pop (page, {"blocked": {}, "loaded": 0})
+		blocked = ", ".join (f"{resource}: {count}" for resource, count in sorted (stats ["blocked"].items ()))
+		total = sum (stats ["blocked"].values ())
+
+		# Aborted requests never say how big they would have been, so this is
+		# what was avoided by count and what was still transferred
+		print (f"Scraped {label}: blocked {total} requests ({blocked}), loaded {stats ['loaded'] / 1024:.0f} KiB", file = sys.stderr)
+
+class PagePool:
+	# Long-lived, stealth-patched pages handed out for scraping. The queue holds
+	# idle pages, plus a None for every slot that still needs a page opened
+
+	def __init__ (self, context:BrowserContext, size:int):
+		self.context = context
+		self.idle = asyncio.Queue ()
+		for _ in range (size):
+			self.idle.put_nowait (None)
+
+	async def open (self) -> Page:
+		page = await self.context.new_page ()
 		await stealth_async (page)
+		return page
+
+	async def warm (self):
+		# Open every page up front so the first checks don't pay for it
+		pages = []
+		while not self.idle.empty ():
+			page = self.idle.get_nowait ()
+			pages.append (page if page is not None else await self.open ())
+
+		for page in pages:
+			self.idle.put_nowait (page)
+
+	async def acquire (self) -> Page:
+		page = await self.idle.get ()
+
+		if page is None or page.is_closed ():
+			try:
+				page = await self.open ()
+			except:
+				self.idle.put_nowait (None)
+				raise
+
+		return page
+
+	async def release (self, page:Page, healthy:bool = True):
+		if healthy is True and not page.is_closed ():
+			try:
+				# Cheap reset that drops the previous timeline
+				await page.goto ("about:blank")
+				self.idle.put_nowait (page)
+				return
+			except:
+				pass
+
+		# Recycle the page, a fresh one gets opened on the next acquire
+		try:
+			await page.close ()
+		except:
+			pass
 
-		await page.goto ("https://twitter.com/i/flow/login")
+		self.idle.put_nowait (None)
 
-		field_locator = page.locator ('input')
-		username_field = field_locator.first
-		await username_field.fill (username)
+	@contextlib.asynccontextmanager
+	async def page (self):
+		page = await self.acquire ()
 
-		button_locator = page.locator ('span', has_text = "Next")
-		next_button = button_locator.first
-		await next_button.click ()
+		try:
+			yield page
+		except:
+			await self.release (page, healthy = False)
+			raise
 
-		field_locator = page.locator ('input')
-		password_field = field_locator.last
-		await password_field.fill (password)
+		await self.release (page)
 
-		button_locator = page.locator ('span', has_text = "Log in")
-		login_button = button_locator.first
-		await login_button.click ()
+	async def close (self):
+		while not self.idle.empty ():
+			page = self.idle.get_nowait ()
+			if page is not None:
+				await page.close ()
 
-		await page.wait_for_url ("**/home")
+# ==============================================================================
 
-		if page.url.endswith ("/home"):
-			await page.close ()
-			return True
+async def twitter_login (pages:PagePool, username:str, password:str) -> bool:
+	async with pages.page () as page:
+		try:
+			await page.goto ("https://twitter.com/i/flow/login")
 
-	except:
-		pass
+			field_locator = page.locator ('input')
+			username_field = field_locator.first
+			await username_field.fill (username)
+
+			button_locator = page.locator ('span', has_text = "Next")
+			next_button = button_locator.first
+			await next_button.click ()
+
+			field_locator = page.locator ('input')
+			password_field = field_locator.last
+			await password_field.fill (password)
+
+			button_locator = page.locator ('span', has_text = "Log in")
+			login_button = button_locator.first
+			await login_button.click ()
+
+			await page.wait_for_url ("**/home")
+
+			if page.url.endswith ("/home"):
+				return True
+
+		except:
+			pass
 
-	await page.close ()
 	return False
 
-async def twitter_is_logged_in (context:BrowserContext) -> bool:
-	try:
-		page = await context.new_page ()
-		await stealth_async (page)
+async def twitter_is_logged_in (pages:PagePool) -> bool:
+	async with pages.page () as page:
+		try:
+			await page.goto ("https://twitter.com")
+			await page.wait_for_url ("**/home", timeout = 3000)
+			if page.url.endswith ("/home"):
+				return True
+			else:
+				return False
 
-		await page.goto ("https://twitter.com")
-		await page.wait_for_url ("**/home", timeout = 3000)
-		if page.url.endswith ("/home"):
-			await page.close ()
+		except:
+			pass
+
+	return False
+
+class TwitterLoggedOutError (Exception):
+	pass
+
+class TwitterRateLimitedError (Exception):
+	def __init__ (self, until:float = None):
+		super ().__init__ (f"Rate limited until {until}" if until is not None else "Rate limited")
+		# When the limit resets, if X said
+		self.until = until
+
+class TwitterSession:
+	# A logged in X account with its browser context and pages. The login
+	# state is cached so checks don't have to load a page to confirm it
+
+	def __init__ (self, context:BrowserContext, pages:PagePool, username:str, password:str, state_path:str, ttl:int, blocker:ResourceBlocker = None, cooldown:int = 900):
+		self.context = context
+		self.pages = pages
+		self.blocker = blocker
+		self.username = username
+		self.password = password
+		self.state_path = state_path
+		self.ttl = ttl
+		# Cached login state is trusted until this time
+		self.valid_until = 0
+		# Set when a scrape looked logged out, forcing a real check
+		self.suspect = False
+		# How long to sit out after being rate limited when X doesn't say
+		self.cooldown = cooldown
+		# Not used for scraping until this time, after being rate limited or
+		# failing to log in
+		self.resting_until = 0
+
+	def available (self) -> bool:
+		return self.resting_until <= time.time ()
+
+	def rest (self, seconds:float):
+		self.resting_until = max (self.resting_until, time.time () + seconds)
+
+	async def has_auth_cookie (self) -> bool:
+		cookies = await self.context.cookies (["https://twitter.com", "https://x.com"])
+		return any (cookie ["name"] == "auth_token" and cookie ["value"] != "" for cookie in cookies)
+
+	async def logged_in (self) -> bool:
+		# Trust the cache, then the auth cookie, and only load a page when a
+		# scrape has given us a reason to doubt the session
+		now = time.time ()
+		if self.valid_until > now:
 			return True
-		else:
-			await page.close ()
+
+		if self.suspect is False and await self.has_auth_cookie () is True:
+			self.valid_until = now + self.ttl
+			return True
+
+		if await twitter_is_logged_in (self.pages) is True:
+			self.suspect = False
+			self.valid_until = now + self.ttl
+			return True
+
+		return False
+
+	async def login (self) -> bool:
+		if await twitter_login (self.pages, self.username, self.password) is False:
 			return False
 
-	except:
-		pass
+		# Save state so we keep the cookies
+		await self.context.storage_state (path = self.state_path)
 
-	await page.close ()
-	return False
+		self.suspect = False
+		self.valid_until = time.time () + self.ttl
+		return True
 
-async def twitter_parse_tweet (element) -> dict:
-	# Here thar be dragons!
+	def logged_out (self):
+		self.valid_until = 0
+		self.suspect = True
+
+	async def get_user_tweets (self, username:str, minimum:int = 10, parser:str = "evaluate", known = None, stop_after:int = 0, render:float = 3, accept:int = None) -> "list[Tweet]":
+		try:
+			return await twitter_get_user_tweets (self.pages, username, minimum, parser, known, stop_after, render, accept, self.blocker)
+		except TwitterLoggedOutError:
+			self.logged_out ()
+			raise
+		except TwitterRateLimitedError as exception:
+			self.rest (exception.until - time.time () if exception.until is not None else self.cooldown)
+			raise
+
+class TwitterSessionRing:
+	# Spreads watched usernames over every X login with consistent hashing,
+	# so each username sticks to one session and adding or losing a login
+	# only moves the usernames that hashed to it. Usernames whose session is
+	# logged out or rate limited move on to the next session around the ring
+
+	def __init__ (self, sessions:list[TwitterSession], replicas:int = 64):
+		self.sessions = sessions
+		# (hash, session index) for several points per session, which evens
+		# out how many usernames each one gets
+		self.ring = sorted (
+			(twitter_ring_hash (f"{session.username}#{replica}"), index)
+			for index, session in enumerate (sessions)
+			for replica in range (0, replicas)
+		)
+		self.keys = [key for key, index in self.ring]
+
+	def candidates (self, username:str) -> list[TwitterSession]:
+		# Every session, in ring order starting from the one username hashes to
+		start = bisect.bisect (self.keys, twitter_ring_hash (username.lower ()))
+		order = []
+		for offset in range (0, len (self.ring)):
+			session = self.sessions [self.ring [(start + offset) % len (self.ring)][1]]
+			if session not in order:
+				order.append (session)
+				if len (order) == len (self.sessions):
+					break
+		return order
+
+	async def ready (self, failed_login:int) -> bool:
+		# Make sure every session that isn't sitting out is logged in. True if
+		# at least one is usable
+		ready = False
+		for session in self.sessions:
+			if session.available () is False:
+				continue
 
-	tweet = {
+			if await session.logged_in () is False:
+				# We're not logged in... we'll try logging in, which also saves
+				# state so we keep the cookies
+				if await session.login () is False:
+					# Login failed! Complain to the console and leave this one
+					# out for a while so we don't spin hard on trying to login
+					print (f"Error: Failed to log into Twitter as {session.username}!", file = sys.stderr)
+					session.rest (failed_login)
+					continue
+
+			ready = True
+
+		return ready
+
+	async def get_user_tweets (self, username:str, minimum:int = 10, parser:str = "evaluate", known = None, stop_after:int = 0, render:float = 3, accept:int = None) -> "list[Tweet]":
+		for session in self.candidates (username):
+			if session.available () is False or session.suspect is True:
+				continue
+
+			try:
+				return await session.get_user_tweets (username, minimum, parser, known, stop_after, render, accept)
+			except (TwitterLoggedOutError, TwitterRateLimitedError) as exception:
+				# Hand it to the next session around the ring
+				print (f"Error: Failed to check {username} as {session.username}: {exception!r}", file = sys.stderr)
+
+		raise RuntimeError (f"No Twitter login available to check {username}")
+
+def twitter_ring_hash (key:str) -> int:
+	# Stable across runs, unlike hash ()
+	return int.from_bytes (hashlib.md5 (key.encode ("utf-8")).digest () [:8], "big")
+
+def twitter_logins (config:dict) -> list[dict]:
+	# Every X login to scrape with, each with its own browser state file. The
+	# first keeps using state.json, the rest default to files in the state
+	# directory, which twitcord.sh mounts so they survive the container
+	logins = config ["twitter"]["logins"] or [config ["twitter"]["login"]]
+	return [
+		{
+			"username": login ["username"],
+			"password": login ["password"],
+			"state": login.get ("state") or ("state.json" if index == 0 else os.path.join ("state", f"state-{index}.json")),
+		}
+		for index, login in enumerate (logins)
+	]
+
+# Where each piece of a post lives inside its <article>. Shared by every
+# parser so they all agree on the layout
+TWITTER_SELECTORS = {
+	"article": "section > h1 + div > div > div > div > div > article",
+	"repost": "div > div > div:nth-of-type(1) a > span",
+	"pinned": "div > div > div:nth-of-type(1) div > span",
+	# Previously:
+	#   div > div > div:nth-of-type(2) > div:nth-of-type(1) > div > div > div > div > div > div > div > div > a > div > div > div > div > img
+	#   div > div > div:nth-of-type(2) > div:nth-of-type(1) a > div > div > div > div > img
+	"avatar": "div > div > div:nth-of-type(2) > div:nth-of-type(1) img",
+	# Previously:
+	#   div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(1) div > span > span
+	"name": "div > div > div:nth-of-type(2) > div:nth-of-type(2) > div > div > div > div > div > div:nth-of-type(1) > div > a > div > div > span > span",
+	"username": "div > div > div:nth-of-type(2) > div:nth-of-type(2) > div > div > div > div > div > div:nth-of-type(2) > div > div > a > div > span",
+	"time": "div > div > div:nth-of-type(2) > div:nth-of-type(2) > div > div > div > div > div > div:nth-of-type(2) > div > div a > time",
+	"content": "div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(2) > div > *",
+	"media": "div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(3) > div > div > div > div > div > div a > div > div > img, div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(3) > div > div > div > div > div > div > a > div > div div > img, div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(3) div > video",
+}
+
+def twitter_new_tweet () -> dict:
+	return {
 		"id": None,
 		"timestamp": None,
 		"author": {
@@ -200,57 +702,148 @@ async def twitter_parse_tweet (element) -> dict:
 		},
 	}
 
+# The parsers build the dict form above, which is also what comes back from
+# the page and what the fixtures hold. Once parsed, posts are kept in these
+# more compact records instead, with the flags packed into an int
+
+TWEET_REPOST = 1
+TWEET_PINNED = 2
+TWEET_IMAGE = 4
+TWEET_VIDEO = 8
+
+TWEET_FLAGS = {
+	"is_repost": TWEET_REPOST,
+	"is_pinned": TWEET_PINNED,
+	"has_image": TWEET_IMAGE,
+	"has_video": TWEET_VIDEO,
+}
+
+@dataclasses.dataclass (slots = True)
+class Author:
+	username:str = None
+	name:str = None
+	avatar:str = None
+
+@dataclasses.dataclass (slots = True)
+class RichTextPart:
+	url:str
+	text:str
+
+@dataclasses.dataclass (slots = True)
+class Media:
+	type:str
+	image:str = None
+	video:str = None
+
+@dataclasses.dataclass (slots = True)
+class Tweet:
+	id:str = None
+	timestamp:str = None
+	author:Author = dataclasses.field (default_factory = Author)
+	flags:int = 0
+	richtext:list[RichTextPart] = dataclasses.field (default_factory = list)
+	media:list[Media] = dataclasses.field (default_factory = list)
+
+	@property
+	def text (self) -> str:
+		# Always the richtext run together, so it isn't stored twice
+		return "".join (part.text for part in self.richtext)
+
+	@classmethod
+	def from_dict (cls, tweet:dict) -> "Tweet":
+		flags = 0
+		for name, bit in TWEET_FLAGS.items ():
+			if tweet ["flags"][name] is True:
+				flags |= bit
+
+		return cls (
+			tweet ["id"],
+			tweet ["timestamp"],
+			Author (tweet ["author"]["username"], tweet ["author"]["name"], tweet ["author"]["avatar"]),
+			flags,
+			[RichTextPart (part ["url"], part ["text"]) for part in tweet ["content"]["richtext"]],
+			[Media (item ["type"], item.get ("image"), item.get ("video")) for item in tweet ["content"]["media"]],
+		)
+
+	def to_dict (self) -> dict:
+		tweet = twitter_new_tweet ()
+		tweet ["id"] = self.id
+		tweet ["timestamp"] = self.timestamp
+		tweet ["author"] = {
+			"username": self.author.username,
+			"name": self.author.name,
+			"avatar": self.author.avatar,
+		}
+		tweet ["flags"] = {name: self.flags & bit != 0 for name, bit in TWEET_FLAGS.items ()}
+		tweet ["content"]["text"] = self.text
+		tweet ["content"]["richtext"] = [{"url": part.url, "text": part.text} for part in self.richtext]
+		for item in self.media:
+			if item.type == "video":
+				tweet ["content"]["media"].append ({"type": item.type, "video": item.video, "image": item.image})
+			else:
+				tweet ["content"]["media"].append ({"type": item.type, "image": item.image})
+		return tweet
+
+def twitter_resolve_url (url:str) -> str:
+	# Resolve relative and other URL forms
+	if url.startswith ("//"):
+		return f"https:{url}"
+	elif url.startswith ("/"):
+		return f"https://twitter.com{url}"
+	elif url.startswith ("http://") or url.startswith ("https://"):
+		return url
+	else:
+		return f"https://twitter.com/{url}"
+
+async def twitter_parse_tweet (element) -> dict:
+	# Here thar be dragons!
+
+	tweet = twitter_new_tweet ()
+
 	# Check for repost
-	locator = element.locator ("div > div > div:nth-of-type(1) a > span")
+	locator = element.locator (TWITTER_SELECTORS ["repost"])
 	if await locator.count () > 0:
 		text = await locator.first.inner_text ()
 		if re.search (r"\s+reposted$", text) is not None:
 			tweet ["flags"]["is_repost"] = True
 
 	# Check for pinned
-	locator = element.locator ("div > div > div:nth-of-type(1) div > span")
+	locator = element.locator (TWITTER_SELECTORS ["pinned"])
 	if await locator.count () > 0:
 		text = await locator.first.inner_text ()
 		if text == "Pinned":
 			tweet ["flags"]["is_pinned"] = True
 
 	# Author avatar
-	#locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(1) > div > div > div > div > div > div > div > div > a > div > div > div > div > img")
-	#locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(1) a > div > div > div > div > img")
-	locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(1) img")
+	locator = element.locator (TWITTER_SELECTORS ["avatar"])
 	if await locator.count () > 0:
 		tweet ["author"]["avatar"] = await locator.first.get_attribute ("src")
 
 	# Author name
-	locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(2) > div > div > div > div > div > div:nth-of-type(1) > div > a > div > div > span > span")
-	#locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(1) div > span > span")
+	locator = element.locator (TWITTER_SELECTORS ["name"])
 	if await locator.count () > 0:
 		tweet ["author"]["name"] = await locator.first.inner_text ()
 
 	# Author username
-	locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(2) > div > div > div > div > div > div:nth-of-type(2) > div > div > a > div > span")
-	#locator = element.locator ("")
+	locator = element.locator (TWITTER_SELECTORS ["username"])
 	if await locator.count () > 0:
 		text = await locator.first.inner_text ()
 		tweet ["author"]["username"] = re.sub (r"^@", "", text)
 
 	# ID
-	locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(2) > div > div > div > div > div > div:nth-of-type(2) > div > div a > time")
-	#locator = element.locator ("")
+	locator = element.locator (TWITTER_SELECTORS ["time"])
 	if await locator.count () > 0:
 		text = await locator.evaluate ("node => node.parentElement.getAttribute('href')")
 		tweet ["id"] = text
 
 	# Timestamp
-	locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(2) > div > div > div > div > div > div:nth-of-type(2) > div > div a > time")
-	#locator = element.locator ("")
+	locator = element.locator (TWITTER_SELECTORS ["time"])
 	if await locator.count () > 0:
 		text = await locator.first.get_attribute ("datetime")
 		tweet ["timestamp"] = text
 
 	# Content text and richtext
-	locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(2) > div > *")
-	#locator = element.locator ("")
+	locator = element.locator (TWITTER_SELECTORS ["content"])
 	content_elements = await locator.all ()
 	for content_element in content_elements:
 		locator = content_element.locator ("a")
@@ -264,17 +857,7 @@ async def twitter_parse_tweet (element) -> dict:
 			anchors = await locator.all ()
 			for anchor in anchors:
 				text = await anchor.inner_text ()
-				url = await anchor.get_attribute ("href")
-
-				# Resolve relative and other URL forms
-				if url.startswith ("//"):
-					url = f"https:{url}"
-				elif url.startswith ("/"):
-					url = f"https://twitter.com{url}"
-				elif url.startswith ("http://") or url.startswith ("https://"):
-					pass
-				else:
-					url = f"https://twitter.com/{url}"
+				url = twitter_resolve_url (await anchor.get_attribute ("href"))
 
 				tweet ["content"]["text"] += text
 				tweet ["content"]["richtext"].append ({
@@ -290,15 +873,15 @@ async def twitter_parse_tweet (element) -> dict:
 			})
 
 		else:
-			tweet ["content"]["text"] += await content_element.inner_text ()
+			text = await content_element.inner_text ()
+			tweet ["content"]["text"] += text
 			tweet ["content"]["richtext"].append ({
 				"url": None,
-				"text": await content_element.inner_text ()
+				"text": text
 			})
 
 	# Content media
-	locator = element.locator ("div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(3) > div > div > div > div > div > div a > div > div > img, div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(3) > div > div > div > div > div > div > a > div > div div > img, div > div > div:nth-of-type(2) > div:nth-of-type(2) > div:nth-of-type(3) div > video")
-	#locator = element.locator ("")
+	locator = element.locator (TWITTER_SELECTORS ["media"])
 	medias = await locator.all ()
 	for media in medias:
 		src = await media.get_attribute ("src");
@@ -325,27 +908,595 @@ async def twitter_parse_tweet (element) -> dict:
 
 	return tweet
 
-async def twitter_get_user_tweets (context:BrowserContext, username:str, minimum:int = 10) -> list[dict]:
-	tweets = []
+# The same parsing as twitter_parse_tweet, run inside the page so a whole
+# screen of posts comes back from a single round-trip
+TWITTER_EXTRACT_SCRIPT = """
+({selectors, only}) => {
+	const resolve = (url) => {
+		if (url.startsWith ("//")) {
+			return "https:" + url;
+		} else if (url.startsWith ("/")) {
+			return "https://twitter.com" + url;
+		} else if (url.startsWith ("http://") || url.startsWith ("https://")) {
+			return url;
+		}
+		return "https://twitter.com/" + url;
+	};
+
+	const parse = (element) => {
+		const tweet = {
+			id: null,
+			timestamp: null,
+			author: {username: null, name: null, avatar: null},
+			flags: {is_repost: false, is_pinned: false, has_image: false, has_video: false},
+			content: {text: "", richtext: [], media: []},
+		};
+
+		let node = element.querySelector (selectors.repost);
+		if (node !== null && /\\s+reposted$/.test (node.innerText)) {
+			tweet.flags.is_repost = true;
+		}
+
+		node = element.querySelector (selectors.pinned);
+		if (node !== null && node.innerText === "Pinned") {
+			tweet.flags.is_pinned = true;
+		}
+
+		node = element.querySelector (selectors.avatar);
+		if (node !== null) {
+			tweet.author.avatar = node.getAttribute ("src");
+		}
+
+		node = element.querySelector (selectors.name);
+		if (node !== null) {
+			tweet.author.name = node.innerText;
+		}
+
+		node = element.querySelector (selectors.username);
+		if (node !== null) {
+			tweet.author.username = node.innerText.replace (/^@/, "");
+		}
+
+		node = element.querySelector (selectors.time);
+		if (node !== null) {
+			tweet.id = node.parentElement.getAttribute ("href");
+			tweet.timestamp = node.getAttribute ("datetime");
+		}
+
+		for (const content of element.querySelectorAll (selectors.content)) {
+			const anchors = content.querySelectorAll ("a");
+			const alt = content.getAttribute ("alt");
+			let parts;
+
+			if (anchors.length !== 0) {
+				parts = Array.from (anchors, (anchor) => ({
+					url: resolve (anchor.getAttribute ("href") || ""),
+					text: anchor.innerText,
+				}));
+			} else if (alt !== null) {
+				parts = [{url: null, text: alt}];
+			} else {
+				parts = [{url: null, text: content.innerText}];
+			}
+
+			for (const part of parts) {
+				tweet.content.text += part.text;
+				tweet.content.richtext.push (part);
+			}
+		}
+
+		for (const media of element.querySelectorAll (selectors.media)) {
+			const poster = media.getAttribute ("poster");
+
+			if (poster === null) {
+				tweet.flags.has_image = true;
+				tweet.content.media.push ({type: "image", image: media.getAttribute ("src")});
+			} else {
+				tweet.flags.has_video = true;
+				tweet.content.media.push ({type: "video", video: media.getAttribute ("src"), image: poster});
+			}
+		}
+
+		return tweet;
+	};
+
+	return Array.from (document.querySelectorAll (selectors.article))
+		.filter ((element) => only === null || only.includes (TWITTER_ID (element, selectors)))
+		.map (parse);
+}
+"""
+
+# Just the id and flags (as TWEET_FLAGS bits) of every article on screen,
+# enough to decide which ones are worth parsing
+TWITTER_IDS_SCRIPT = """
+({selectors, bits}) => Array.from (document.querySelectorAll (selectors.article), (element) => {
+	let flags = 0;
+
+	const repost = element.querySelector (selectors.repost);
+	if (repost !== null && /\\s+reposted$/.test (repost.innerText)) {
+		flags |= bits.is_repost;
+	}
+
+	const pinned = element.querySelector (selectors.pinned);
+	if (pinned !== null && pinned.innerText === "Pinned") {
+		flags |= bits.is_pinned;
+	}
+
+	for (const media of element.querySelectorAll (selectors.media)) {
+		flags |= media.getAttribute ("poster") === null ? bits.has_image : bits.has_video;
+	}
+
+	return [TWITTER_ID (element, selectors), flags];
+})
+"""
+
+TWITTER_HTML_SCRIPT = """
+({selectors, only}) => Array.from (document.querySelectorAll (selectors.article))
+	.filter ((element) => only === null || only.includes (TWITTER_ID (element, selectors)))
+	.map ((element) => element.outerHTML)
+"""
+
+# Resolves true as soon as an article we haven't seen shows up, or false
+# once the timeout passes without one
+TWITTER_WAIT_SCRIPT = """
+({selectors, seen, timeout}) => new Promise ((resolve) => {
+	const ready = () => Array.from (document.querySelectorAll (selectors.article)).some ((element) => {
+		const id = TWITTER_ID (element, selectors);
+		return id !== null && !seen.includes (id);
+	});
+
+	if (ready ()) {
+		resolve (true);
+		return;
+	}
+
+	const observer = new MutationObserver (() => {
+		if (ready ()) {
+			observer.disconnect ();
+			clearTimeout (timer);
+			resolve (true);
+		}
+	});
+	const timer = setTimeout (() => {
+		observer.disconnect ();
+		resolve (false);
+	}, timeout);
+
+	observer.observe (document.body, {childList: true, subtree: true});
+})
+"""
+
+# Shared by the scripts above, wrapped around each of them before use
+TWITTER_ID_FUNCTION = """
+const TWITTER_ID = (element, selectors) => {
+	const time = element.querySelector (selectors.time);
+	return time !== null ? time.parentElement.getAttribute ("href") : null;
+};
+"""
+
+def twitter_script (script:str) -> str:
+	return f"(arg) => {{ {TWITTER_ID_FUNCTION} return ({script.strip ()}) (arg); }}"
+
+# Offline parsing of serialized <article> HTML, field by field so each can be
+# measured on its own
+
+def twitter_html_text (element) -> str:
+	# Close enough to innerText for the inline markup posts are made of
+	parts = []
+	for node in element.descendants:
+		if type (node) is NavigableString:
+			parts.append (str (node))
+		elif node.name == "br":
+			parts.append ("\n")
+	return "".join (parts)
+
+def twitter_html_flags (element, tweet:dict):
+	node = element.select_one (TWITTER_SELECTORS ["repost"])
+	if node is not None and re.search (r"\s+reposted$", twitter_html_text (node)) is not None:
+		tweet ["flags"]["is_repost"] = True
+
+	node = element.select_one (TWITTER_SELECTORS ["pinned"])
+	if node is not None and twitter_html_text (node) == "Pinned":
+		tweet ["flags"]["is_pinned"] = True
+
+def twitter_html_author (element, tweet:dict):
+	node = element.select_one (TWITTER_SELECTORS ["avatar"])
+	if node is not None:
+		tweet ["author"]["avatar"] = node.get ("src")
+
+	node = element.select_one (TWITTER_SELECTORS ["name"])
+	if node is not None:
+		tweet ["author"]["name"] = twitter_html_text (node)
+
+	node = element.select_one (TWITTER_SELECTORS ["username"])
+	if node is not None:
+		tweet ["author"]["username"] = re.sub (r"^@", "", twitter_html_text (node))
+
+def twitter_html_id (element, tweet:dict):
+	node = element.select_one (TWITTER_SELECTORS ["time"])
+	if node is not None:
+		tweet ["id"] = node.parent.get ("href")
+		tweet ["timestamp"] = node.get ("datetime")
+
+def twitter_html_content (element, tweet:dict):
+	for content_element in element.select (TWITTER_SELECTORS ["content"]):
+		anchors = content_element.select ("a")
+
+		if len (anchors) != 0:
+			parts = [
+				{
+					"url": twitter_resolve_url (anchor.get ("href", "")),
+					"text": twitter_html_text (anchor),
+				}
+				for anchor in anchors
+			]
+
+		elif content_element.get ("alt") is not None:
+			parts = [{"url": None, "text": content_element.get ("alt")}]
+
+		else:
+			parts = [{"url": None, "text": twitter_html_text (content_element)}]
+
+		for part in parts:
+			tweet ["content"]["text"] += part ["text"]
+			tweet ["content"]["richtext"].append (part)
+
+def twitter_html_media (element, tweet:dict):
+	for media in element.select (TWITTER_SELECTORS ["media"]):
+		if media.get ("poster") is None:
+			tweet ["flags"]["has_image"] = True
+			tweet ["content"]["media"].append ({
+				"type": "image",
+				"image": media.get ("src"),
+			})
+
+		else:
+			tweet ["flags"]["has_video"] = True
+			tweet ["content"]["media"].append ({
+				"type": "video",
+				"video": media.get ("src"),
+				"image": media.get ("poster"),
+			})
+
+TWITTER_HTML_FIELDS = {
+	"flags": twitter_html_flags,
+	"author": twitter_html_author,
+	"id": twitter_html_id,
+	"content": twitter_html_content,
+	"media": twitter_html_media,
+}
+
+def twitter_html_article (html:str):
+	# Accepts either the <article> itself or just its inner HTML
+	document = BeautifulSoup (html, "lxml")
+	article = document.find ("article")
+	return article if article is not None else document
+
+def twitter_parse_tweet_html (html:str) -> dict:
+	element = twitter_html_article (html)
+
+	tweet = twitter_new_tweet ()
+	for parse in TWITTER_HTML_FIELDS.values ():
+		parse (element, tweet)
+
+	return tweet
+
+async def twitter_parse_tweets (page:Page, parser:str = "evaluate", only:list[str] = None) -> list[dict]:
+	# Parse the articles on screen, or just the ones with ids in only
+	if parser == "evaluate":
+		return await page.evaluate (twitter_script (TWITTER_EXTRACT_SCRIPT), {"selectors": TWITTER_SELECTORS, "only": only})
+
+	elif parser == "html":
+		articles = await page.evaluate (twitter_script (TWITTER_HTML_SCRIPT), {"selectors": TWITTER_SELECTORS, "only": only})
+		return [twitter_parse_tweet_html (article) for article in articles]
+
+	elif parser == "locator":
+		tweets = []
+		for tweet_element in await page.locator (TWITTER_SELECTORS ["article"]).all ():
+			if only is not None:
+				locator = tweet_element.locator (TWITTER_SELECTORS ["time"])
+				if await locator.count () == 0:
+					continue
+				if await locator.first.evaluate ("node => node.parentElement.getAttribute('href')") not in only:
+					continue
+
+			tweets.append (await twitter_parse_tweet (tweet_element))
+		return tweets
+
+	else:
+		raise ValueError (f"Invalid parser: {parser}")
+
+async def twitter_wait_for_tweets (page:Page, seen:list[str], timeout:float) -> bool:
+	# Wait for the timeline to render something new instead of sleeping a
+	# fixed amount, giving up after timeout seconds
+	return await page.evaluate (
+		twitter_script (TWITTER_WAIT_SCRIPT),
+		{"selectors": TWITTER_SELECTORS, "seen": seen, "timeout": timeout * 1000}
+	)
+
+# ------------------------------------------------------------------------------
+# The UserTweets GraphQL responses the timeline is rendered from
+
+TWITTER_GRAPHQL_PATTERN = re.compile (r"/graphql/[^/]+/UserTweets\b")
+
+def twitter_graphql_instructions (data) -> list:
+	# The instructions list moves around between API revisions, so go find it
+	if isinstance (data, dict):
+		if isinstance (data.get ("instructions"), list):
+			return data ["instructions"]
+		values = data.values ()
+	elif isinstance (data, list):
+		values = data
+	else:
+		return []
+
+	for value in values:
+		instructions = twitter_graphql_instructions (value)
+		if len (instructions) != 0:
+			return instructions
+
+	return []
+
+def twitter_graphql_results (data) -> list[tuple]:
+	# (tweet result, is pinned) for every post in the response
+	entries = []
+	for instruction in twitter_graphql_instructions (data):
+		if instruction.get ("type") == "TimelinePinEntry":
+			entries.append ((instruction.get ("entry", {}), True))
+		for entry in instruction.get ("entries", []):
+			entries.append ((entry, False))
+
+	results = []
+	for entry, is_pinned in entries:
+		content = entry.get ("content", {})
+		items = [content.get ("itemContent", {})]
+		items += [item.get ("item", {}).get ("itemContent", {}) for item in content.get ("items", [])]
+
+		for item in items:
+			result = item.get ("tweet_results", {}).get ("result")
+			if result is not None:
+				results.append ((result, is_pinned))
+
+	return results
+
+def twitter_graphql_unwrap (result:dict) -> dict:
+	if result.get ("__typename") == "TweetWithVisibilityResults":
+		return result.get ("tweet", {})
+	return result
+
+def twitter_graphql_richtext (text:str, entities:dict) -> list[dict]:
+	# Split the text on its links, mentions and hashtags the same way the
+	# rendered post would be. Entity indices count characters of the
+	# unescaped text
+	links = []
+	for url in entities.get ("urls", []):
+		links.append ((url ["indices"], url.get ("expanded_url") or url ["url"], url.get ("display_url")))
+	for mention in entities.get ("user_mentions", []):
+		links.append ((mention ["indices"], f"https://twitter.com/{mention ['screen_name']}", None))
+	for hashtag in entities.get ("hashtags", []):
+		links.append ((hashtag ["indices"], f"https://twitter.com/hashtag/{hashtag ['text']}?src=hashtag_click", None))
+
+	richtext = []
+	position = 0
+	for (start, end), url, display in sorted (links, key = lambda link: link [0][0]):
+		if start < position or end > len (text):
+			continue
+
+		if start > position:
+			richtext.append ({"url": None, "text": text [position:start]})
+		richtext.append ({"url": url, "text": display if display is not None else text [start:end]})
+		position = end
+
+	if position < len (text):
+		richtext.append ({"url": None, "text": text [position:]})
+
+	return richtext
+
+def twitter_graphql_tweet (result:dict, is_pinned:bool = False) -> dict:
+	result = twitter_graphql_unwrap (result)
+	legacy = result.get ("legacy")
+	if legacy is None or "rest_id" not in result:
+		return None
+
+	tweet = twitter_new_tweet ()
+	tweet ["flags"]["is_pinned"] = is_pinned
+
+	# Reposts are shown as the original post, so that's what we return
+	repost = legacy.get ("retweeted_status_result", {}).get ("result")
+	if repost is not None:
+		original = twitter_graphql_tweet (repost)
+		if original is not None:
+			original ["flags"]["is_repost"] = True
+			original ["flags"]["is_pinned"] = is_pinned
+			return original
+
+	user = result.get ("core", {}).get ("user_results", {}).get ("result", {})
+	username = user.get ("core", {}).get ("screen_name") or user.get ("legacy", {}).get ("screen_name")
+
+	tweet ["id"] = f"/{username}/status/{result ['rest_id']}"
+	tweet ["timestamp"] = datetime.datetime.strptime (legacy ["created_at"], "%a %b %d %H:%M:%S %z %Y").strftime ("%Y-%m-%dT%H:%M:%S.000Z")
+	tweet ["author"]["username"] = username
+	tweet ["author"]["name"] = user.get ("core", {}).get ("name") or user.get ("legacy", {}).get ("name")
+	tweet ["author"]["avatar"] = user.get ("avatar", {}).get ("image_url") or user.get ("legacy", {}).get ("profile_image_url_https")
+
+	# Long posts keep their full text somewhere else
+	note = result.get ("note_tweet", {}).get ("note_tweet_results", {}).get ("result")
+	if note is not None:
+		richtext = twitter_graphql_richtext (html.unescape (note ["text"]), note.get ("entity_set", {}))
+	else:
+		full_text = html.unescape (legacy ["full_text"])
+		start, end = legacy.get ("display_text_range", [0, len (full_text)])
+		entities = {
+			key: [
+				dict (entity, indices = [entity ["indices"][0] - start, entity ["indices"][1] - start])
+				for entity in legacy.get ("entities", {}).get (key, [])
+				if entity ["indices"][0] >= start and entity ["indices"][1] <= end
+			]
+			for key in ("urls", "user_mentions", "hashtags")
+		}
+		richtext = twitter_graphql_richtext (full_text [start:end], entities)
+
+	tweet ["content"]["richtext"] = richtext
+	tweet ["content"]["text"] = "".join (part ["text"] for part in richtext)
+
+	for media in legacy.get ("extended_entities", {}).get ("media", []):
+		if media ["type"] == "photo":
+			tweet ["flags"]["has_image"] = True
+			tweet ["content"]["media"].append ({
+				"type": "image",
+				"image": f"{media ['media_url_https']}?name=orig",
+			})
+
+		elif media ["type"] in ("video", "animated_gif"):
+			variants = [
+				variant for variant in media.get ("video_info", {}).get ("variants", [])
+				if variant.get ("content_type") == "video/mp4"
+			]
+			tweet ["flags"]["has_video"] = True
+			tweet ["content"]["media"].append ({
+				"type": "video",
+				"video": max (variants, key = lambda variant: variant.get ("bitrate", 0)) ["url"] if len (variants) != 0 else None,
+				"image": media ["media_url_https"],
+			})
+
+	return tweet
+
+def twitter_graphql_tweets (data) -> dict:
+	# Snowflake -> tweet for every post in a UserTweets response
+	tweets = {}
+	for result, is_pinned in twitter_graphql_results (data):
+		try:
+			tweet = twitter_graphql_tweet (result, is_pinned)
+		except (KeyError, TypeError, ValueError):
+			# Something we don't understand, the DOM parser will handle it
+			continue
+
+		if tweet is not None:
+			tweets [tweet ["id"].rsplit ("/", 1)[-1]] = tweet
+
+	return tweets
 
-	page = await context.new_page ()
-	await stealth_async (page)
+TWITTER_LOGGED_OUT_PATTERN = re.compile (r"/(i/flow/)?login\b")
+
+async def twitter_get_user_tweets (pages:PagePool, username:str, minimum:int = 10, parser:str = "evaluate", known = None, stop_after:int = 0, render:float = 3, accept:int = None, blocker:ResourceBlocker = None) -> list[Tweet]:
+	async with pages.page () as page:
+		if blocker is None or blocker.counting is False:
+			return await twitter_scrape_user_tweets (page, username, minimum, parser, known, stop_after, render, accept)
+
+		blocker.reset (page)
+		try:
+			return await twitter_scrape_user_tweets (page, username, minimum, parser, known, stop_after, render, accept)
+		finally:
+			blocker.report (page, f"@{username}")
+
+async def twitter_scrape_user_tweets (page:Page, username:str, minimum:int = 10, parser:str = "evaluate", known = None, stop_after:int = 0, render:float = 3, accept:int = None) -> list[Tweet]:
+	# known is an optional id -> bool callable. Posts it recognizes come back
+	# as Tweets holding only the id and flags instead of being parsed, and
+	# stop_after of them in a row (pins aside) ends the scrape early. Each
+	# screen waits up to render seconds for new posts to show up. accept is an
+	# optional filter mask (see tweet_filter_mask), posts it rejects come back
+	# unparsed the same way
+
+	# The graphql parser reads the UserTweets responses as they arrive and
+	# only falls back to the DOM for posts it couldn't find in them
+	captured = {} if parser == "graphql" else None
+	# Reset times of any rate limited UserTweets responses, which leave the
+	# timeline empty
+	limited = []
+
+	async def capture (response):
+		if TWITTER_GRAPHQL_PATTERN.search (response.url) is None:
+			return
+
+		if response.status == 429:
+			limited.append (response.headers.get ("x-rate-limit-reset"))
+			return
+
+		if captured is None:
+			return
+
+		try:
+			captured.update (twitter_graphql_tweets (await response.json ()))
+		except Exception:
+			pass
+
+	page.on ("response", capture)
+
+	try:
+		tweets = await twitter_scrape_timeline (page, username, minimum, "evaluate" if parser == "graphql" else parser, known, stop_after, render, accept, captured)
+	finally:
+		page.remove_listener ("response", capture)
+
+	if len (tweets) == 0 and len (limited) != 0:
+		raise TwitterRateLimitedError (int (limited [-1]) if limited [-1] is not None and limited [-1].isdigit () else None)
+
+	return tweets
+
+async def twitter_scrape_timeline (page:Page, username:str, minimum:int, parser:str, known, stop_after:int, render:float, accept:int = None, captured:dict = None) -> list[Tweet]:
+	# id -> Tweet in timeline order, None while a post is waiting to be parsed
+	tweets = {}
+	# How many already-known posts we've seen in a row
+	known_run = 0
 
 	await page.goto (f"https://twitter.com/{username}")
 
+	# Logged out sessions get bounced to the login flow
+	if TWITTER_LOGGED_OUT_PATTERN.search (page.url) is not None:
+		raise TwitterLoggedOutError (f"Redirected to {page.url}")
+
 	while True:
-		await asyncio.sleep (3)
+		if await twitter_wait_for_tweets (page, list (tweets.keys ()), render) is False:
+			# Nothing new rendered in time, the end of the timeline
+			break
 
 		previous_tweets_length = len (tweets)
 
-		tweet_locator = page.locator ("section > h1 + div > div > div > div > div > article")
-		tweet_elements = await tweet_locator.all ()
+		# Cheap pass over what's on screen so only posts we haven't seen
+		# before get the full parse
+		wanted = []
+		for id, flags in await page.evaluate (twitter_script (TWITTER_IDS_SCRIPT), {"selectors": TWITTER_SELECTORS, "bits": TWEET_FLAGS}):
+			if id is None or id in tweets:
+				continue
 
-		for tweet_element in tweet_elements:
-			tweets.append (await twitter_parse_tweet (tweet_element))
+			is_pinned = flags & TWEET_PINNED != 0
+
+			if known is not None and known (id) is True:
+				tweets [id] = Tweet (id, flags = flags)
 
-		tweets = {tweet ["id"]: tweet for tweet in tweets}
-		tweets = list (tweets.values ())
+				if is_pinned is False:
+					known_run += 1
+
+				if stop_after > 0 and known_run >= stop_after:
+					# Anything further down is older than this run
+					break
+
+			else:
+				if accept is not None and (accept >> flags) & 1 == 0:
+					# Nobody wants it, so there's no point parsing it
+					tweets [id] = Tweet (id, flags = flags)
+				else:
+					tweets [id] = None
+					wanted.append (id)
+
+				if is_pinned is False:
+					known_run = 0
+
+		# Take whatever the intercepted responses already have
+		if captured is not None:
+			for id in list (wanted):
+				tweet = captured.get (id.rsplit ("/", 1)[-1])
+				if tweet is not None:
+					tweets [id] = Tweet.from_dict (dict (tweet, id = id))
+					wanted.remove (id)
+
+		if len (wanted) != 0:
+			for tweet in await twitter_parse_tweets (page, parser, only = wanted):
+				if tweet ["id"] in tweets:
+					tweets [tweet ["id"]] = Tweet.from_dict (tweet)
+
+		if stop_after > 0 and known_run >= stop_after:
+			# Caught up with what we've already seen
+			break
 
 		if len (tweets) >= minimum:
 			# We have enough posts now
@@ -357,139 +1508,786 @@ async def twitter_get_user_tweets (context:BrowserContext, username:str, minimum
 
 		await page.evaluate ("window.scrollTo (0, document.body.scrollHeight);")
 
-	await page.close ()
-	return tweets
+	return [tweet for tweet in tweets.values () if tweet is not None]
 
 # ==============================================================================
 
-async def tweet_to_discord_embed (tweet:dict, config:dict) -> dict:
-	embed = {
-		"username": config ["discord"]["embed"]["username"],
-		"avatar_url": config ["discord"]["embed"]["avatar_url"],
-		"attachments": [],
-		"flags": config ["discord"]["embed"]["flags"],
-		"content": None,
-		"embeds": [
-			{
-				"title": "View on X",
-				"description": "",
-				"url": f"https://twitter.com{tweet['id']}",
-				"color": config ["discord"]["embed"]["color"],
-				"fields": [],
-				"author": {
-					"name": tweet ["author"]["name"],
-					"url": f"https://twitter.com/{tweet ['author']['username']}",
-					"icon_url": tweet ["author"]["avatar"],
-				},
-				"footer": {
-					"text": f"@{tweet ['author']['username']}",
-				},
-				"timestamp": tweet ["timestamp"],
-			}
-		]
+def http_open (config:dict) -> aiohttp.ClientSession:
+	# One long-lived, pooled client for every outbound request so connections,
+	# TLS sessions and DNS lookups get reused
+	return aiohttp.ClientSession (
+		connector = aiohttp.TCPConnector (
+			limit = config ["http"]["limit"],
+			limit_per_host = config ["http"]["limit_per_host"],
+			ttl_dns_cache = config ["http"]["dns_cache"],
+			keepalive_timeout = config ["http"]["keepalive"],
+		),
+		timeout = aiohttp.ClientTimeout (
+			total = config ["http"]["timeout"],
+			connect = config ["http"]["connect_timeout"],
+		),
+	)
+
+# ==============================================================================
+
+# Markdown escaping for post text. Inline markup is escaped anywhere, block
+# quotes, lists and headings only at the start. A replace per character that
+# actually shows up beats both a regex and str.translate, whose escapes are
+# longer than one character
+DISCORD_ESCAPE_TABLE = tuple ((character, f"\\{character}") for character in "`_*~()[]")
+DISCORD_ESCAPE_PREFIX_PATTERN = re.compile (r"^(\s*)(?:([>-])|(#{1,6})\s+)")
+DISCORD_IMAGE_SIZE_PATTERN = re.compile (r"&name=small\b")
+
+def discord_escape (text:str) -> str:
+	for character, escaped in DISCORD_ESCAPE_TABLE:
+		if character in text:
+			text = text.replace (character, escaped)
+
+	match = DISCORD_ESCAPE_PREFIX_PATTERN.match (text)
+	if match is None:
+		return text
+
+	return f"{match.group (1)}\\{match.group (2) or match.group (3)}{text [match.end ():]}"
+
+def discord_embed_template (config:dict, watch:dict) -> dict:
+	# The parts of a webhook's messages that only depend on configuration,
+	# worked out once instead of for every post. A watch's own embed settings
+	# override discord.embed
+	settings = dict (config ["discord"]["embed"], **(watch.get ("embed") or {}))
+	return {
+		"username": settings ["username"],
+		"avatar_url": settings ["avatar_url"],
+		"flags": settings ["flags"],
+		"color": settings ["color"],
 	}
 
-	for part in tweet ["content"]["richtext"]:
-		text = re.sub (r"([`_*~()\[\]])", r"\\\1", part ["text"])
-		text = re.sub (r"^(\s*)([>-])", r"\1\\\2", text)
-		text = re.sub (r"^(\s*)(#{1,6})\s+", r"\1\\\2", text)
+# What Discord accepts in a single webhook message
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_EMBED_CHARACTERS = 6000
+DISCORD_MAX_DESCRIPTION = 4096
+
+def discord_description (parts:list[str], limit:int) -> str:
+	# Join the rendered richtext, cutting it short with an ellipsis if it
+	# won't fit in limit characters. Links are dropped whole rather than cut,
+	# so the markup stays intact
+	if sum (len (part) for part in parts) <= limit:
+		return "".join (parts)
+
+	# Leave room for the ellipsis
+	limit -= 1
+	kept = []
+	length = 0
+	for part in parts:
+		if length + len (part) > limit:
+			if part.startswith ("[") is False:
+				# Don't leave half an escape at the end
+				kept.append (part [:limit - length].rstrip ("\\"))
+			break
 
-		if part ["url"] is not None:
-			embed ["embeds"][0]["description"] += f"[{text}]({part ['url']})"
-		else:
-			embed ["embeds"][0]["description"] += text
+		kept.append (part)
+		length += len (part)
+
+	return "".join (kept) + "\u2026"
+
+def discord_render_embed (tweet:Tweet, template:dict, video_url:str = None) -> dict:
+	url = f"https://twitter.com{tweet.id}"
+
+	main = {
+		"title": "View on X",
+		"description": "",
+		"url": url,
+		"color": template ["color"],
+		"fields": [],
+		"author": {
+			"name": tweet.author.name,
+			"url": f"https://twitter.com/{tweet.author.username}",
+			"icon_url": tweet.author.avatar,
+		},
+		"footer": {
+			"text": f"@{tweet.author.username}",
+		},
+		"timestamp": tweet.timestamp,
+	}
+	embeds = [main]
 
+	# Discord ignores "video" in webhook embeds, so videos are shown by their
+	# poster with a note, and any direct links go in the note
 	needs_video_notice = False
-	for item in tweet ["content"]["media"]:
-		if item ["type"] == "image":
-			embed ["embeds"].append ({
-				"url": f"https://twitter.com{tweet['id']}",
+	video_links = []
+	for item in tweet.media:
+		if item.type == "image":
+			embeds.append ({
+				"url": url,
 				"image": {
-					"url": re.sub (r"&name=small\b", "", item ["image"])
+					"url": DISCORD_IMAGE_SIZE_PATTERN.sub ("", item.image)
 				}
 			})
 
-		elif item ["type"] == "video":
-			url = None # await vxtwitter_get_video_url (tweet ["id"])
-			if url is not None:
-				embed ["embeds"][0]["video"] = {
-					"url": url
+		elif item.type == "video":
+			needs_video_notice = True
+
+			# Intercepted API responses already carry a direct link
+			if item.video is not None and item.video.startswith ("https://"):
+				video_links.append (item.video)
+			elif video_url is not None:
+				video_links.append (video_url)
+
+			embeds.append ({
+				"url": url,
+				"image": {
+					"url": DISCORD_IMAGE_SIZE_PATTERN.sub ("", item.image)
 				}
-			else:
-				needs_video_notice = True
-				embed ["embeds"].append ({
-					"url": f"https://twitter.com{tweet['id']}",
-					"image": {
-						"url": re.sub (r"&name=small\b", "", item ["image"])
-					}
-				})
+			})
 
 	if needs_video_notice is True:
-		embed ["embeds"][0]["fields"].append ({
+		value = "Post contains a video. To view it, click \"View on X\" above."
+		video_links = list (dict.fromkeys (video_links))
+		if len (video_links) == 1:
+			value += f" Direct link: [video]({video_links [0]})"
+		elif len (video_links) > 1:
+			value += " Direct links: " + ", ".join (f"[video {index}]({link})" for index, link in enumerate (video_links, 1))
+
+		main ["fields"].append ({
 			"name": "Note",
-			"value": "Post contains a video. To view it, click \"View on X\" above.",
+			"value": value,
 			"inline": False
 		})
 
-	return embed
+	# Long posts from the graphql parser can run far past what Discord takes
+	# in one embed, or one message, and an oversized one is refused outright
+	main ["description"] = discord_description (
+		[
+			f"[{discord_escape (part.text)}]({part.url})" if part.url is not None else discord_escape (part.text)
+			for part in tweet.richtext
+		],
+		min (DISCORD_MAX_DESCRIPTION, DISCORD_MAX_EMBED_CHARACTERS - discord_embed_length (main)),
+	)
+
+	return {
+		"username": template ["username"],
+		"avatar_url": template ["avatar_url"],
+		"attachments": [],
+		"flags": template ["flags"],
+		"content": None,
+		"embeds": embeds,
+	}
 
-async def discord_send_webhook (url:str, embed:dict) -> bool:
-	async with aiohttp.ClientSession () as session:
-		async with session.post (url, json = embed) as response:
-			return await response.text ()
+async def tweet_to_discord_embed (tweet:Tweet, template:dict, videos:"VideoResolver" = None) -> dict:
+	# One lookup covers every video in the post
+	video_url = None
+	if videos is not None and tweet.flags & TWEET_VIDEO != 0:
+		video_url = await videos.resolve (tweet.id)
+
+	return discord_render_embed (tweet, template, video_url)
+
+def discord_embed_length (embed:dict) -> int:
+	# The characters Discord counts towards a message's embed limit
+	length = len (embed.get ("title") or "") + len (embed.get ("description") or "")
+	length += len ((embed.get ("author") or {}).get ("name") or "")
+	length += len ((embed.get ("footer") or {}).get ("text") or "")
+	for field in embed.get ("fields") or []:
+		length += len (field.get ("name") or "") + len (field.get ("value") or "")
+	return length
+
+def discord_pack_fits (payloads:list[dict], payload:dict) -> bool:
+	# Whether payload's embeds can join the message made from payloads. Only
+	# messages that differ in nothing but their embeds can be combined
+	if any ({**other, "embeds": None} != {**payload, "embeds": None} for other in payloads):
+		return False
 
-# ==============================================================================
+	embeds = [embed for other in payloads + [payload] for embed in other ["embeds"]]
+	if len (embeds) > DISCORD_MAX_EMBEDS:
+		return False
 
-async def vxtwitter_get_video_url (id:str) -> str:
-	response = None
+	return sum (discord_embed_length (embed) for embed in embeds) <= DISCORD_MAX_EMBED_CHARACTERS
+
+def discord_pack (payloads:list[dict]) -> dict:
+	# One message holding the embeds of every payload, in order
+	if len (payloads) == 1:
+		return payloads [0]
+	return dict (payloads [0], embeds = [embed for payload in payloads for embed in payload ["embeds"]])
+
+async def discord_send_webhook (http:aiohttp.ClientSession, url:str, embed:dict) -> tuple:
+	# Returns the response's status, headers and body
+	async with http.post (url, json = embed) as response:
+		return response.status, response.headers, await response.text ()
+
+class Outbox:
+	# Append-only journal of embeds waiting for delivery, so a restart picks up
+	# where it left off instead of losing them. Lines are ["add", seq,
+	# webhook, embed] when queued and ["done", seq] once delivered
+
+	def __init__ (self, path:str):
+		self.path = path
+		self.file = None
+		# seq -> (webhook, embed), oldest first
+		self.pending = {}
+		self.seq = 0
+		# Lines in the journal, to know when it's worth compacting
+		self.lines = 0
+
+	def load (self):
+		if not os.path.isfile (self.path):
+			return
+
+		# Drop a torn write at the end of the journal before anything gets
+		# appended after it
+		truncate_torn (self.path)
+
+		with open (self.path, "r", encoding = "utf-8") as fh:
+			for line in fh:
+				try:
+					entry = json.loads (line)
+				except ValueError:
+					# A damaged line, skip it
+					continue
 
-	async with aiohttp.ClientSession () as session:
-		response = await session.get (
-			f"https://vxtwitter.com{id}",
-			headers = {
-				"User-Agent": "Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)"
-			}
-		)
-		response = await response.text ()
+				self.lines += 1
+
+				if entry [0] == "add":
+					self.pending [entry [1]] = (entry [2], entry [3])
+					self.seq = max (self.seq, entry [1])
+				elif entry [0] == "done":
+					self.pending.pop (entry [1], None)
+
+	def write (self, entries:list[list]):
+		if self.file is None:
+			self.file = open (self.path, "a", encoding = "utf-8")
+
+		self.file.write ("".join (json.dumps (entry, separators = (",", ":")) + "\n" for entry in entries))
+		self.file.flush ()
+		os.fsync (self.file.fileno ())
+		self.lines += len (entries)
+
+	def add (self, webhook:str, embed:dict) -> int:
+		self.seq += 1
+		self.write ([["add", self.seq, webhook, embed]])
+		self.pending [self.seq] = (webhook, embed)
+		return self.seq
+
+	def done (self, seq:int):
+		if self.pending.pop (seq, None) is None:
+			return
+
+		self.write ([["done", seq]])
+
+		# Rewrite the journal once it's mostly delivered entries
+		if self.lines > 2 * len (self.pending) + 100:
+			self.compact ()
+
+	def compact (self):
+		self.close ()
+		entries = [["add", seq, webhook, embed] for seq, (webhook, embed) in self.pending.items ()]
+		atomic_write (self.path, "".join (json.dumps (entry, separators = (",", ":")) + "\n" for entry in entries))
+		self.lines = len (entries)
+
+	def close (self):
+		if self.file is not None:
+			self.file.close ()
+			self.file = None
+
+class DiscordDelivery:
+	# A queue per webhook, each drained in order by its own worker so a slow
+	# or rate limited webhook never holds up scraping or the other webhooks.
+	# Posts waiting together are packed into as few messages as Discord's
+	# limits allow
+
+	def __init__ (self, http:aiohttp.ClientSession, outbox:Outbox, retries:int = 5, backoff:float = 1, cooldown:float = 60):
+		self.http = http
+		self.outbox = outbox
+		self.retries = retries
+		self.backoff = backoff
+		# Seconds before posts that ran out of retries are queued again
+		self.cooldown = cooldown
+		# webhook -> queue of embeds waiting to go out
+		self.queues = {}
+		self.workers = {}
+		# webhook -> time (monotonic) its rate limit bucket refills
+		self.limited_until = {}
+		# Time (monotonic) a global rate limit ends
+		self.global_until = 0
+
+	def send (self, webhook:str, embed:dict):
+		# Written to the outbox before anything else, so once this returns the
+		# post survives a restart
+		self.enqueue (webhook, self.outbox.add (webhook, embed), embed)
+
+	def replay (self):
+		# Queue up whatever the outbox still holds from before a restart
+		for seq, (webhook, embed) in list (self.outbox.pending.items ()):
+			self.enqueue (webhook, seq, embed)
+
+	def enqueue (self, webhook:str, seq:int, embed:dict):
+		if webhook not in self.queues:
+			self.queues [webhook] = asyncio.Queue ()
+			self.workers [webhook] = asyncio.create_task (self.worker (webhook))
+
+		self.queues [webhook].put_nowait ((seq, embed))
+
+	async def worker (self, webhook:str):
+		queue = self.queues [webhook]
+		# Taken off the queue but didn't fit in the last message
+		held = None
+		# Posts still in the outbox after running out of retries, or after
+		# something unexpected went wrong. They hold up the rest of the queue
+		# and go again after the cooldown, so the webhook's posts stay in order
+		stranded = []
 
-	page = BeautifulSoup (response, "html5lib")
-	elements = page.css.select ('head meta[property="og:video"]')
-	if len (elements) == 0:
-		return None
+		while True:
+			if len (stranded) != 0:
+				await asyncio.sleep (self.cooldown)
+				await self.wait_limits (webhook)
+
+				batch = stranded
+				stranded = []
+				# Already counted off the queue when they were first taken
+				fresh = False
+
+			else:
+				if held is None:
+					held = await queue.get ()
+
+				# Let the rate limit pass first, so everything that queued up in
+				# the meantime can go out together
+				await self.wait_limits (webhook)
+
+				# Pack as many queued posts as fit into one message, in order
+				batch = [held]
+				held = None
+				while queue.empty () is False:
+					item = queue.get_nowait ()
+					if discord_pack_fits ([embed for seq, embed in batch], item [1]) is False:
+						held = item
+						break
+					batch.append (item)
+				fresh = True
+
+			# Sequence numbers that are out of the outbox
+			finished = set ()
+
+			try:
+				results = [await self.deliver (webhook, discord_pack ([embed for seq, embed in batch]))] * len (batch)
+
+				if results [0] is False and len (batch) > 1:
+					# Something in the message was refused, so send them one at
+					# a time to only lose that one
+					results = [await self.deliver (webhook, embed) for seq, embed in batch]
+
+				for (seq, embed), result in zip (batch, results):
+					if result is not None:
+						self.outbox.done (seq)
+						finished.add (seq)
+			except Exception as error:
+				print (f"Error: Failed to deliver to webhook: {error!r}", file = sys.stderr)
+			finally:
+				stranded = [(seq, embed) for seq, embed in batch if seq not in finished]
+				if len (stranded) != 0:
+					print (f"Error: {len (stranded)} post(s) left in the outbox, trying again in {self.cooldown} seconds", file = sys.stderr)
+
+				if fresh is True:
+					for _ in batch:
+						queue.task_done ()
+
+	async def wait_limits (self, webhook:str):
+		# Wait out whatever rate limit applies
+		delay = max (self.global_until, self.limited_until.get (webhook, 0)) - time.monotonic ()
+		if delay > 0:
+			await asyncio.sleep (delay)
+
+	async def deliver (self, webhook:str, embed:dict) -> bool:
+		# True once delivered and False if Discord refused it for good, both of
+		# which take it out of the outbox. None leaves it there for the next
+		# restart to try again
+		for attempt in range (self.retries + 1):
+			await self.wait_limits (webhook)
+
+			try:
+				status, headers, body = await discord_send_webhook (self.http, webhook, embed)
+			except (aiohttp.ClientError, asyncio.TimeoutError):
+				await asyncio.sleep (self.backoff * 2 ** attempt)
+				continue
+
+			self.update_limits (webhook, status, headers, body)
 
-	if "content" not in elements [0].attrs:
+			if 200 <= status < 300:
+				return True
+
+			elif status == 429:
+				# update_limits already knows how long to wait
+				continue
+
+			elif status >= 500:
+				await asyncio.sleep (self.backoff * 2 ** attempt)
+				continue
+
+			else:
+				print (f"Error: Webhook rejected the post with {status}: {body}", file = sys.stderr)
+				return False
+
+		print (f"Error: Gave up delivering to webhook after {self.retries + 1} attempts", file = sys.stderr)
 		return None
 
-	return elements [0]["content"]
+	def update_limits (self, webhook:str, status:int, headers, body:str):
+		now = time.monotonic ()
+
+		# The bucket is empty, so hold off until it refills
+		if headers.get ("X-RateLimit-Remaining") == "0" and headers.get ("X-RateLimit-Reset-After") is not None:
+			try:
+				self.limited_until [webhook] = now + float (headers ["X-RateLimit-Reset-After"])
+			except ValueError:
+				self.limited_until [webhook] = now + self.backoff
+
+		if status == 429:
+			try:
+				details = json.loads (body)
+			except ValueError:
+				details = {}
+			if not isinstance (details, dict):
+				details = {}
+
+			try:
+				retry_after = float (details.get ("retry_after", headers.get ("Retry-After", self.backoff)))
+			except (TypeError, ValueError):
+				retry_after = self.backoff
+
+			if details.get ("global") is True or headers.get ("X-RateLimit-Global") == "true":
+				self.global_until = now + retry_after
+			else:
+				self.limited_until [webhook] = now + retry_after
+
+	async def join (self):
+		for queue in list (self.queues.values ()):
+			await queue.join ()
+
+	async def close (self):
+		for worker in self.workers.values ():
+			worker.cancel ()
+
+		self.outbox.close ()
 
 # ==============================================================================
 
-HISTORY_LOCK = asyncio.Lock ()
+class VxtwitterHeadParser (html.parser.HTMLParser):
+	# Picks og:video out of the <head> and notes when the head is over, so
+	# the rest of the page never has to be read
+
+	def __init__ (self):
+		super ().__init__ ()
+		self.video = None
+		self.done = False
+
+	def handle_starttag (self, tag:str, attrs:list):
+		if tag == "meta":
+			attrs = dict (attrs)
+			if attrs.get ("property") == "og:video" and self.video is None:
+				self.video = attrs.get ("content")
+
+		elif tag == "body":
+			self.done = True
+
+	def handle_endtag (self, tag:str):
+		if tag == "head":
+			self.done = True
+
+# Bytes past the head read just to keep a connection reusable
+VXTWITTER_DRAIN_LIMIT = 65536
+
+async def vxtwitter_get_video_url (http:aiohttp.ClientSession, id:str) -> str:
+	parser = VxtwitterHeadParser ()
+	decoder = codecs.getincrementaldecoder ("utf-8") (errors = "replace")
+
+	async with http.get (
+		f"https://vxtwitter.com{id}",
+		headers = {
+			"User-Agent": "Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)"
+		}
+	) as response:
+		# Rate limits and errors come back as pages without og:video, which
+		# mustn't be mistaken for posts without one
+		response.raise_for_status ()
+
+		# Stop parsing as soon as the head has been parsed. The rest of a
+		# small page is still read (and thrown away) so the connection goes
+		# back to the pool, anything bigger isn't worth it and the connection
+		# is closed instead
+		drained = 0
+		async for chunk in response.content.iter_chunked (4096):
+			if parser.done is False:
+				parser.feed (decoder.decode (chunk))
+				continue
+
+			drained += len (chunk)
+			if drained > VXTWITTER_DRAIN_LIMIT:
+				break
+
+	return parser.video
+
+class VideoResolver:
+	# Cached, de-duplicated vxtwitter lookups keyed by post id
+
+	def __init__ (self, http:aiohttp.ClientSession, size:int = 1024, ttl:float = 3600):
+		self.http = http
+		self.cache = TTLCache (size, ttl)
+		# id -> future for lookups already in flight
+		self.pending = {}
+
+	async def resolve (self, id:str) -> str:
+		found, url = self.cache.get (id)
+		if found is True:
+			return url
+
+		if id not in self.pending:
+			self.pending [id] = asyncio.ensure_future (self.lookup (id))
+
+		return await asyncio.shield (self.pending [id])
 
-async def history_has (webhook:str, username:str = None, id:str = None, mode:str = None) -> bool:
+	async def lookup (self, id:str) -> str:
+		try:
+			url = await vxtwitter_get_video_url (self.http, id)
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			# Not cached, so the next post with this id tries again
+			url = None
+		else:
+			self.cache.set (id, url)
+		finally:
+			self.pending.pop (id, None)
+
+		return url
+
+# ==============================================================================
+
+def history_parse_mode (mode:str = None) -> str:
 	if mode is None:
-		mode = "by-author"
+		return "by-author"
 	elif mode.lower () not in ("by-account", "by-author"):
 		raise ValueError (f"Invalid history mode: {mode}")
 	else:
-		mode = mode.lower ()
+		return mode.lower ()
+
+HISTORY_ID_PATTERN = re.compile (r"^/([^/]+)/status/(\d+)$")
+
+def history_normalize_id (id:str = None) -> str:
+	if id is None:
+		return None
+
+	return HISTORY_ID_PATTERN.sub (r"\1/\2", id).lower ()
+
+def history_id_order (id:str) -> int:
+	# Ids end in the post's snowflake, which sorts by creation time
+	try:
+		return int (id.rsplit ("/", 1)[-1])
+	except ValueError:
+		return 0
+
+# History entries are (webhook, username, id, seen) tuples. An id of None
+# records that the username has been seen under the webhook, and seen is the
+# last time (epoch seconds) the id showed up on the account's timeline
+
+class HistoryLogBackend:
+	# Append-only log of JSON arrays, one entry per line. Later lines for the
+	# same id refresh its seen time
+
+	def __init__ (self, path:str):
+		self.path = path
+		self.file = None
+
+	def load (self) -> list[tuple]:
+		entries = []
+
+		if not os.path.isfile (self.path):
+			return entries
+
+		# Drop a torn write at the end of the log before anything gets
+		# appended after it
+		truncate_torn (self.path)
+
+		with open (self.path, "r", encoding = "utf-8") as fh:
+			for line in fh:
+				try:
+					entry = json.loads (line)
+				except ValueError:
+					# A damaged line, skip it
+					continue
+
+				if isinstance (entry, list) and len (entry) == 4:
+					entries.append (tuple (entry))
+
+		return entries
+
+	def append (self, entries:list[tuple]):
+		if self.file is None:
+			self.file = open (self.path, "a", encoding = "utf-8")
+
+		self.file.write ("".join (json.dumps (list (entry), separators = (",", ":")) + "\n" for entry in entries))
+		self.file.flush ()
+		os.fsync (self.file.fileno ())
+
+	def compact (self, entries:list[tuple]):
+		self.close ()
+		atomic_write (self.path, "".join (json.dumps (list (entry), separators = (",", ":")) + "\n" for entry in entries))
+
+	def close (self):
+		if self.file is not None:
+			self.file.close ()
+			self.file = None
+
+class HistoryJsonBackend:
+	# The original {webhook: {username: [id, ...]}} file, rewritten atomically
+	# on every commit. Slower than the others and has nowhere to keep seen
+	# times, but keeps history.json in use
+
+	def __init__ (self, path:str):
+		self.path = path
+		self.history = {}
+
+	def load (self) -> list[tuple]:
+		if not os.path.isfile (self.path):
+			return []
+
+		entries = history_import_json (self.path)
+		for webhook, username, id, seen in entries:
+			self.history.setdefault (webhook, {}).setdefault (username, [])
+			if id is not None:
+				self.history [webhook][username].append (id)
 
-	if id is not None:
-		id = re.sub (r"^/([^/]+)/status/(\d+)$", r"\1/\2", id)
+		return entries
 
-	async with HISTORY_LOCK:
-		async with aiofiles.open ("history.json", mode = "r") as fh:
-			contents = await fh.read ()
-		history = json.loads (contents)
+	def append (self, entries:list[tuple]):
+		changed = False
+		for webhook, username, id, seen in entries:
+			if username not in self.history.setdefault (webhook, {}):
+				self.history [webhook][username] = []
+				changed = True
 
-		if webhook not in history:
+			if id is not None and id not in self.history [webhook][username]:
+				self.history [webhook][username].append (id)
+				changed = True
+
+		if changed is True:
+			atomic_write (self.path, json.dumps (self.history, separators = (",", ":")))
+
+	def compact (self, entries:list[tuple]):
+		self.history = {}
+		for webhook, username, id, seen in entries:
+			ids = self.history.setdefault (webhook, {}).setdefault (username, [])
+			if id is not None:
+				ids.append (id)
+
+		atomic_write (self.path, json.dumps (self.history, separators = (",", ":")))
+
+	def close (self):
+		pass
+
+class HistorySqliteBackend:
+	def __init__ (self, path:str):
+		self.path = path
+		self.db = sqlite3.connect (path)
+		self.db.execute ("CREATE TABLE IF NOT EXISTS history (webhook TEXT NOT NULL, username TEXT NOT NULL, id TEXT NOT NULL DEFAULT '', seen INTEGER NOT NULL DEFAULT 0)")
+		self.db.execute ("CREATE UNIQUE INDEX IF NOT EXISTS history_key ON history (webhook, username, id)")
+		self.db.commit ()
+
+	def load (self) -> list[tuple]:
+		return [
+			(webhook, username, id if id != "" else None, seen)
+			for webhook, username, id, seen in self.db.execute ("SELECT webhook, username, id, seen FROM history ORDER BY seen, rowid")
+		]
+
+	def append (self, entries:list[tuple]):
+		self.db.executemany (
+			"INSERT INTO history (webhook, username, id, seen) VALUES (?, ?, ?, ?) ON CONFLICT (webhook, username, id) DO UPDATE SET seen = excluded.seen",
+			[(webhook, username, id if id is not None else "", seen) for webhook, username, id, seen in entries]
+		)
+		self.db.commit ()
+
+	def compact (self, entries:list[tuple]):
+		self.db.execute ("DELETE FROM history")
+		self.append (entries)
+		self.db.execute ("VACUUM")
+
+	def close (self):
+		self.db.close ()
+
+HISTORY_BACKENDS = {
+	"json": HistoryJsonBackend,
+	"log": HistoryLogBackend,
+	"sqlite": HistorySqliteBackend,
+}
+
+class History:
+	# In-memory index of everything that has been seen, loaded once from the
+	# backend at startup so lookups never touch the disk
+
+	def __init__ (self, backend, count:int = None, ttl:int = 0, refresh:int = 3600):
+		self.backend = backend
+		# Newest ids kept per account, None to keep everything
+		self.count = count
+		# Seconds since last seen before an id is dropped, 0 to keep forever
+		self.ttl = ttl
+		# Seconds before a still-visible id has its seen time written out again
+		self.refresh = refresh
+		# webhook -> username -> {id: seen}, oldest first
+		self.accounts = {}
+		# webhook -> {id: number of usernames holding it}, for by-author lookups
+		self.authors = {}
+
+	def load (self, legacy_path:str = None):
+		entries = self.backend.load ()
+
+		# Nothing stored yet, so bring in the old history.json if there is one
+		if len (entries) == 0 and legacy_path is not None and os.path.isfile (legacy_path):
+			entries = history_import_json (legacy_path)
+			if len (entries) != 0:
+				self.backend.append (entries)
+
+		for webhook, username, id, seen in entries:
+			self.index (webhook, username, id, seen)
+
+		self.trim ()
+
+	def index (self, webhook:str, username:str, id:str = None, seen:int = 0) -> bool:
+		# Returns True when something new was indexed. Indexing a known id
+		# moves it to the newest end of its account
+		added = False
+
+		if webhook not in self.accounts:
+			self.accounts [webhook] = {}
+			self.authors [webhook] = {}
+			added = True
+
+		if username not in self.accounts [webhook]:
+			self.accounts [webhook][username] = {}
+			added = True
+
+		if id is not None:
+			ids = self.accounts [webhook][username]
+			if id in ids:
+				del ids [id]
+			else:
+				self.authors [webhook][id] = self.authors [webhook].get (id, 0) + 1
+				added = True
+			ids [id] = seen
+
+		return added
+
+	def forget (self, webhook:str, username:str, id:str):
+		del self.accounts [webhook][username][id]
+
+		self.authors [webhook][id] -= 1
+		if self.authors [webhook][id] == 0:
+			del self.authors [webhook][id]
+
+	def has (self, webhook:str, username:str = None, id:str = None, mode:str = None) -> bool:
+		mode = history_parse_mode (mode)
+		id = history_normalize_id (id)
+
+		if webhook not in self.accounts:
 			return False
 
 		if mode == "by-account":
-			if username is not None and username.lower () not in history [webhook]:
+			if username is not None and username.lower () not in self.accounts [webhook]:
 				return False
 
-			if username is not None and id is not None and id.lower () not in history [webhook][username.lower ()]:
+			if username is not None and id is not None and id not in self.accounts [webhook][username.lower ()]:
 				return False
 
 			return True
@@ -498,231 +2296,630 @@ async def history_has (webhook:str, username:str = None, id:str = None, mode:str
 			if id is None:
 				return True
 
-			for user in history [webhook].keys ():
-				if id.lower () in history [webhook][user]:
-					return True
+			return id in self.authors [webhook]
 
-			return False
+	def add (self, webhook:str, username:str = None, id:str = None, mode:str = None):
+		if username is None:
+			return
 
-async def history_add (webhook:str, username:str = None, id:str = None, mode:str = None):
-	if mode is None:
-		mode = "by-author"
-	elif mode.lower () not in ("by-account", "by-author"):
-		raise ValueError (f"Invalid history mode: {mode}")
-	else:
-		mode = mode.lower ()
+		self.add_many (webhook, username, [id] if id is not None else [], mode = mode)
 
-	if id is not None:
-		id = re.sub (r"^/([^/]+)/status/(\d+)$", r"\1/\2", id)
+	def add_many (self, webhook:str, username:str, ids:list[str], mode:str = None):
+		# Index a whole batch and commit it to the backend in a single write.
+		# Ids already known only get written again once their seen time is
+		# stale, so retention survives restarts
+		history_parse_mode (mode)
+		username = username.lower ()
+		now = int (time.time ())
 
-	async with HISTORY_LOCK:
-		async with aiofiles.open ("history.json", mode = "r") as fh:
-			contents = await fh.read ()
-		history = json.loads (contents)
+		# Oldest posts first so the newest end up newest in the index
+		ids = sorted (
+			[history_normalize_id (id) for id in ids if id is not None],
+			key = history_id_order
+		)
+
+		# Nothing to add, so don't mark the account as known either. An empty
+		# backfill gets retried on the next check instead of everything on the
+		# timeline being sent as new
+		if len (ids) == 0:
+			return
+
+		entries = []
+		if self.index (webhook, username, seen = now) is True:
+			entries.append ((webhook, username, None, now))
+
+		known = self.accounts [webhook][username]
+		for id in ids:
+			stale = id not in known or known [id] + self.refresh <= now
+			if self.index (webhook, username, id, now) is True or stale is True:
+				entries.append ((webhook, username, id, now))
+
+		if len (entries) != 0:
+			self.backend.append (entries)
+
+		self.trim_account (webhook, username, now)
+
+	def trim_account (self, webhook:str, username:str, now:int):
+		ids = self.accounts [webhook][username]
+
+		# Oldest first, so the front of the account is what expires
+		if self.ttl > 0:
+			for id, seen in list (ids.items ()):
+				if seen + self.ttl > now:
+					break
+				self.forget (webhook, username, id)
+
+		if self.count is not None:
+			for id in list (ids.keys ())[:max (len (ids) - self.count, 0)]:
+				self.forget (webhook, username, id)
+
+	def trim (self):
+		now = int (time.time ())
+		for webhook, accounts in self.accounts.items ():
+			for username in accounts.keys ():
+				self.trim_account (webhook, username, now)
+
+	def compact (self):
+		# Drop expired ids and rewrite the backend with only what's left
+		self.trim ()
+
+		entries = []
+		for webhook, accounts in self.accounts.items ():
+			for username, ids in accounts.items ():
+				entries.append ((webhook, username, None, 0))
+				for id, seen in ids.items ():
+					entries.append ((webhook, username, id, seen))
+
+		self.backend.compact (entries)
+
+	def close (self):
+		self.backend.close ()
+
+def history_import_json (path:str) -> list[tuple]:
+	# Flatten the original {webhook: {username: [id, ...]}} layout
+	with open (path, "r", encoding = "utf-8") as fh:
+		contents = fh.read ()
+
+	if contents.strip () == "":
+		return []
+
+	history = json.loads (contents)
+	now = int (time.time ())
+
+	entries = []
+	for webhook, accounts in history.items ():
+		for username, ids in accounts.items ():
+			entries.append ((webhook, username, None, now))
+			for id in ids:
+				entries.append ((webhook, username, id, now))
+
+	return entries
+
+def history_open (config:dict) -> History:
+	if config ["history"]["backend"] not in HISTORY_BACKENDS:
+		raise ValueError (f"Invalid history backend: {config ['history']['backend']}")
+
+	count = config ["history"]["retention"]["count"]
+	if count is None:
+		count = max (config ["twitter"]["history_length"], config ["twitter"]["check_length"])
+
+	# Stores can live in a directory of their own, like data/ under Docker
+	if os.path.dirname (config ["history"]["path"]) != "":
+		os.makedirs (os.path.dirname (config ["history"]["path"]), exist_ok = True)
+
+	history = History (
+		HISTORY_BACKENDS [config ["history"]["backend"]](config ["history"]["path"]),
+		count = count if count > 0 else None,
+		ttl = config ["history"]["retention"]["ttl"],
+		refresh = config ["history"]["refresh"],
+	)
+	history.load (config ["history"]["import"])
+
+	return history
+
+async def history_compact_task (history:History, interval:int):
+	while True:
+		await asyncio.sleep (interval)
+
+		try:
+			history.compact ()
+		except OSError as error:
+			print (f"Error: Failed to compact history: {error}", file = sys.stderr)
 
-		#if mode == "by-account":
-		if webhook not in history:
-			history [webhook] = {}
+# ==============================================================================
 
-		if username is not None and username.lower () not in history [webhook]:
-			history [webhook][username.lower ()] = []
+class Scheduler:
+	# Deadlines for every watched username in a heap, so the main loop can
+	# sleep right up until the next one is due. Every watch of the same
+	# username shares one deadline at the shortest of their intervals
+
+	def __init__ (self, jitter:float = 0):
+		# Up to this many seconds are added to each deadline to spread checks
+		# out instead of having them bunch up
+		self.jitter = jitter
+		# (due, seq, username), with stale entries skipped when popped
+		self.heap = []
+		self.seq = itertools.count ()
+		# username -> {"interval", "subscriptions", "nominal", "seq"}
+		self.accounts = {}
+		# Set whenever a deadline is pushed, so wait () notices one that comes
+		# before the deadline it's sleeping towards
+		self.changed = asyncio.Event ()
+
+	def add (self, username:str, subscriptions:list[tuple], interval:float, due:float = None):
+		# subscriptions are the (watch, username as configured) pairs watching
+		# this username. Holding the watch itself keeps them valid when a
+		# reload moves the watches around
+		if due is None:
+			due = time.time ()
+
+		self.accounts [username] = {
+			"interval": interval,
+			"subscriptions": subscriptions,
+			"nominal": due,
+			"seq": None,
+		}
+		self.push (username, due)
+
+	def remove (self, username:str):
+		self.accounts.pop (username, None)
+
+	def push (self, username:str, nominal:float):
+		account = self.accounts [username]
+		account ["nominal"] = nominal
+		account ["seq"] = next (self.seq)
+		heapq.heappush (self.heap, (nominal + random.uniform (0, self.jitter), account ["seq"], username))
+		self.changed.set ()
+
+	def discard_stale (self):
+		while len (self.heap) != 0:
+			due, seq, username = self.heap [0]
+			if username in self.accounts and self.accounts [username]["seq"] == seq:
+				return
+			heapq.heappop (self.heap)
+
+	def next_due (self) -> float:
+		self.discard_stale ()
+		return self.heap [0][0] if len (self.heap) != 0 else None
+
+	def pop_due (self) -> list[tuple]:
+		# (username, subscriptions) for everything due now, each rescheduled a
+		# full interval after its previous deadline so it's actually an
+		# interval and not a delay between checks
+		now = time.time ()
+		due = []
 
-		if username is not None and id is not None and id.lower () not in history [webhook][username.lower ()]:
-			history [webhook][username.lower ()].append (id.lower ())
+		while True:
+			next_due = self.next_due ()
+			if next_due is None or next_due > now:
+				break
+
+			_, seq, username = heapq.heappop (self.heap)
+			account = self.accounts [username]
+			due.append ((username, account ["subscriptions"]))
+
+			nominal = account ["nominal"] + account ["interval"]
+			if nominal <= now:
+				# We fell behind, so don't fire again straight away
+				nominal = now + account ["interval"]
+			self.push (username, nominal)
+
+		return due
+
+	async def wait (self, idle:float) -> list[tuple]:
+		# Sleep until the next deadline (or idle seconds when there's nothing
+		# scheduled) and return what's due. Returns early if the schedule
+		# changes in the meantime, possibly with nothing due
+		self.changed.clear ()
+		due = self.next_due ()
+		delay = idle if due is None else due - time.time ()
+		if delay > 0:
+			try:
+				await asyncio.wait_for (self.changed.wait (), delay)
+			except asyncio.TimeoutError:
+				pass
+
+		return self.pop_due ()
+
+	def update (self, accounts:dict):
+		# Bring the schedule in line with accounts (username ->
+		# {"subscriptions", "interval"}), keeping the deadlines of usernames
+		# that are still watched so a reload doesn't check everything at once
+		for username in list (self.accounts.keys ()):
+			if username not in accounts:
+				self.remove (username)
+
+		now = time.time ()
+		for username, account in accounts.items ():
+			if username not in self.accounts:
+				self.add (username, account ["subscriptions"], account ["interval"])
+				continue
 
-		#elif mode == "by-author":
-		#	if webhook not in history:
-		#		history [webhook] = []
-		#
-		#	if id is not None and id.lower () not in history [webhook]:
-		#		history [webhook].append (id.lower ())
+			current = self.accounts [username]
+			current ["subscriptions"] = account ["subscriptions"]
+
+			if current ["interval"] != account ["interval"]:
+				current ["interval"] = account ["interval"]
+				# Don't sit out the rest of a longer interval
+				if current ["nominal"] > now + account ["interval"]:
+					self.push (username, now + account ["interval"])
+
+def scheduler_accounts (config:dict) -> dict:
+	# Gather every watch of each username together
+	accounts = {}
+	for watch in config ["watches"]:
+		for username, settings in watch ["accounts"].items ():
+			account = accounts.setdefault (username.lower (), {"subscriptions": [], "interval": settings ["interval"]})
+			account ["subscriptions"].append ((watch, username))
+			account ["interval"] = min (account ["interval"], settings ["interval"])
+
+	return accounts
+
+def scheduler_from_config (config:dict) -> Scheduler:
+	scheduler = Scheduler (config ["twitter"]["delays"]["jitter"])
+	scheduler.update (scheduler_accounts (config))
+	return scheduler
+
+# Settings only read at startup, which need a restart to change
+CONFIG_RESTART_SETTINGS = (
+	("playwright",),
+	("http",),
+	("history",),
+	("vxtwitter",),
+	("discord", "delivery"),
+	("twitter", "login"),
+	("twitter", "logins"),
+	# Copied into each login's session when it's created
+	("twitter", "delays", "login_check"),
+	("twitter", "delays", "rate_limit"),
+)
+
+def config_reload (config:dict, new_config:dict, scheduler:Scheduler):
+	# Swap in new_config, in place so everything holding the configuration
+	# sees it, and reschedule whatever watches changed
+	for path in CONFIG_RESTART_SETTINGS:
+		old_value, new_value = config, new_config
+		for key in path:
+			old_value, new_value = old_value.get (key), new_value.get (key)
+
+		if old_value != new_value:
+			print (f"Error: Changes to {'.'.join (path)} need a restart to take effect", file = sys.stderr)
+
+	config.clear ()
+	config.update (new_config)
+
+	scheduler.jitter = config ["twitter"]["delays"]["jitter"]
+	scheduler.update (scheduler_accounts (config))
+
+async def config_reload_task (path:str, config:dict, scheduler:Scheduler):
+	# Poll the configuration file and apply changes without restarting
+	try:
+		mtime = os.stat (path).st_mtime_ns
+	except OSError:
+		mtime = None
 
-		contents = json.dumps (history, separators = (",", ":"))
-		async with aiofiles.open ("history.json", mode = "w") as fh:
-			await fh.write (contents)
+	while config ["reload"] > 0:
+		await asyncio.sleep (config ["reload"])
 
-# ==============================================================================
+		try:
+			current = os.stat (path).st_mtime_ns
+		except OSError:
+			# Probably in the middle of being replaced
+			continue
+
+		if current == mtime:
+			continue
+		mtime = current
+
+		try:
+			new_config = config_load (path)
+		except Exception as exception:
+			print (f"Error: Failed to reload {path}, keeping the running configuration: {exception!r}", file = sys.stderr)
+			continue
+
+		config_reload (config, new_config, scheduler)
+		print (f"Reloaded {path}", file = sys.stderr)
 
-def add_accounts_last_time (config:dict):
-	# Loop through the watch groups
-	for watch_index in range (0, len (config ["watches"])):
-		# Loop through the watched accounts in the group
-		for username in config ["watches"][watch_index]["accounts"].keys ():
-			# Add a place to store the last checked timestamp
-			config ["watches"][watch_index]["accounts"][username]["last"] = 0
-
-def accounts_ready_to_check (config:dict) -> list[tuple]:
-	# A place to store the webhooks and usernames of the accounts that need
-	# checking
-	to_check = []
-
-	# Loop through the watch groups
-	for watch_index in range (0, len (config ["watches"])):
-		# Loop through the watched accounts and note the ones that are due for
-		# checking
-		for username, settings in config ["watches"][watch_index]["accounts"].items ():
-			# Compare the last check time to the current time
-			if settings ["last"] + settings ["interval"] <= time.time ():
-				# It's ready for checking, so append to the list
-				to_check.append ((
-					watch_index, # config ["watches"][watch_index]["webhook"],
-					username,
-				))
-				# Update the last check time now so it's actually an interval
-				# and not a delay between checks
-				config ["watches"][watch_index]["accounts"][username]["last"] = time.time ()
-
-	return to_check
-
-def tweet_sendable (settings:dict, tweet:dict) -> bool:
+def tweet_filter_accepts (settings:dict, flags:int) -> bool:
 	# Check that the tweet is a type (post, repost, pin) we want to send
-	if settings ["posts"] is False and tweet ["flags"]["is_repost"] is False:
+	if settings ["posts"] is False and flags & TWEET_REPOST == 0:
 		return False
-	if settings ["reposts"] is False and tweet ["flags"]["is_repost"] is True:
+	if settings ["reposts"] is False and flags & TWEET_REPOST != 0:
 		return False
-	if settings ["pinned"] is False and tweet ["flags"]["is_pinned"] is True:
+	if settings ["pinned"] is False and flags & TWEET_PINNED != 0:
 		return False
 
 	# Check for media constraints
 	if (
 		(
 			settings ["with-images"] is True and
-			tweet ["flags"]["has_image"] is True
+			flags & TWEET_IMAGE != 0
 		) or
 		(
 			settings ["with-videos"] is True and
-			tweet ["flags"]["has_video"] is True
+			flags & TWEET_VIDEO != 0
 		) or
 		(
 			settings ["without-media"] is True and
-			tweet ["flags"]["has_image"] is False and
-			tweet ["flags"]["has_video"] is False
+			flags & (TWEET_IMAGE | TWEET_VIDEO) == 0
 		)
 	):
 		return True
 	else:
 		return False
 
+def tweet_filter_mask (settings:dict) -> int:
+	# An account's settings worked out once for every combination of flags.
+	# Bit n is set when a post whose flags are n should be sent
+	mask = 0
+	for flags in range (0, 1 << len (TWEET_FLAGS)):
+		if tweet_filter_accepts (settings, flags) is True:
+			mask |= 1 << flags
+	return mask
+
+def tweet_sendable (mask:int, tweet:Tweet) -> bool:
+	return (mask >> tweet.flags) & 1 == 1
+
+# ==============================================================================
+
+async def check_account (session:TwitterSessionRing, videos:VideoResolver, delivery:DiscordDelivery, config:dict, history:History, subscriptions:list[tuple]):
+	# Scrape a username once for every watch of it that came due together,
+	# then run each watch's filters and history over the shared result
+
+	# Save us a bunch of typing by pulling out what we need for each watch
+	watches = []
+	for watch, username in subscriptions:
+		watches.append ({
+			"webhook": watch ["webhook"],
+			"history": watch ["history"],
+			"filter": watch ["accounts"][username]["filter"],
+			"username": username,
+			"template": watch ["template"],
+			# No history entry (not necessarily history) for this username
+			# under this webhook? It's new!
+			"new": history.has (watch ["webhook"], username, mode = "by-account") is False,
+		})
+
+	# Only posts some watch would send are worth parsing, new watches just
+	# need the ids
+	accept = 0
+	for watch in watches:
+		if watch ["new"] is False:
+			accept |= watch ["filter"]
+
+	if any (watch ["new"] for watch in watches):
+		# Grab a BUNCH of posts because sometimes ordering changes to bring
+		# old posts to the top
+		tweets = await session.get_user_tweets (
+			subscriptions [0][1],
+			minimum = config ["twitter"]["history_length"],
+			parser = config ["twitter"]["parser"],
+			render = config ["twitter"]["delays"]["render"],
+			accept = accept,
+		)
+
+	else:
+		# Just a normal check... Load the user's tweets
+		tweets = await session.get_user_tweets (
+			subscriptions [0][1],
+			minimum = config ["twitter"]["check_length"],
+			parser = config ["twitter"]["parser"],
+			# Posts every watch already has in history come back as bare ids
+			# and a run of them means we've caught up
+			known = lambda id: all (history.has (watch ["webhook"], watch ["username"], id, mode = watch ["history"]) for watch in watches),
+			stop_after = config ["twitter"]["incremental"],
+			render = config ["twitter"]["delays"]["render"],
+			accept = accept,
+		)
+
+	for watch in watches:
+		if watch ["new"] is True:
+			# Add them all to history in one go because we're building out a
+			# new history
+			history.add_many (watch ["webhook"], watch ["username"], [tweet.id for tweet in tweets], mode = watch ["history"])
+			# Next watch please
+			continue
+
+		try:
+			await check_watch (videos, delivery, config, history, watch, tweets)
+		except Exception as exception:
+			# Complain to the console and carry on with the other watches
+			print (f"Error: Failed to check {watch ['username']} for {watch ['webhook']}: {exception!r}", file = sys.stderr)
+
+async def check_watch (videos:VideoResolver, delivery:DiscordDelivery, config:dict, history:History, watch:dict, tweets:list[Tweet]):
+	# Everything seen this check, committed to history at the end
+	seen = []
+
+	# New posts that should go to the webhook
+	sendable = []
+
+	# Time to check the tweets
+	for tweet in tweets:
+		# Add to history regardless of whether or not we send it, which also
+		# keeps known posts from expiring
+		seen.append (tweet.id)
+
+		# Don't send a tweet if we've already sent it
+		if history.has (watch ["webhook"], watch ["username"], tweet.id, mode = watch ["history"]) is True:
+			# Next tweet please
+			continue
+
+		# Is this something we're supposed to send to the webhook?
+		if tweet_sendable (watch ["filter"], tweet) is True:
+			sendable.append (tweet)
+
+	# Oldest first, so posts show up in the channel in the order they were
+	# made and can be packed together into as few messages as possible
+	sendable.sort (key = lambda tweet: history_id_order (tweet.id))
+
+	# Generate the Discord embed objects all at once so their video lookups
+	# happen side by side
+	embeds = await asyncio.gather (*[tweet_to_discord_embed (tweet, watch ["template"], videos) for tweet in sendable])
+
+	for embed in embeds:
+		# Queue the embed object for delivery to the webhook
+		delivery.send (watch ["webhook"], embed)
+
+	# One durable write for the whole account
+	history.add_many (watch ["webhook"], watch ["username"], seen, mode = watch ["history"])
+
 # ==============================================================================
 
 async def main ():
 	# Load configuration
-	config = yaml_load ("config.yaml")
-
-	# Add an entry to each watched username to track the last time it was
-	# checked
-	add_accounts_last_time (config)
+	config = config_load ("config.yaml")
+
+	# Load everything we've already seen into memory
+	history = history_open (config)
+	# Periodically drop expired entries and shrink the history store
+	if config ["history"]["compaction"] > 0:
+		compact_task = asyncio.create_task (history_compact_task (history, config ["history"]["compaction"]))
+
+	# When each watched username is next due to be checked
+	scheduler = scheduler_from_config (config)
+	# Pick up changes to config.yaml as they're made
+	reload_task = asyncio.create_task (config_reload_task ("config.yaml", config, scheduler))
+
+	# Shared HTTP client for Discord and friends
+	http = http_open (config)
+	# Posts go out through per-webhook queues, separately from scraping,
+	# and are journaled in the outbox until Discord accepts them
+	outbox = Outbox (config ["discord"]["delivery"]["outbox"])
+	outbox.load ()
+	delivery = DiscordDelivery (
+		http,
+		outbox,
+		config ["discord"]["delivery"]["retries"],
+		config ["discord"]["delivery"]["backoff"],
+		config ["discord"]["delivery"]["cooldown"],
+	)
+	# Finish delivering anything left over from last time
+	delivery.replay ()
+	# Direct video links for embeds, looked up through vxtwitter
+	videos = VideoResolver (http, config ["vxtwitter"]["cache_size"], config ["vxtwitter"]["cache_ttl"]) if config ["vxtwitter"]["enabled"] is True else None
 
 	# Into the land of the browser
 	async with async_playwright () as playwright:
 		# Start browser
 		browser = await playwright.webkit.launch (headless = True)
 
-		# If no previous browser context state, create one
-		if not os.path.isfile ("state.json"):
-			# Create a new context
+		# Keep images, video, fonts and trackers from loading, we only need
+		# the markup and URLs
+		blocker = ResourceBlocker (
+			config ["playwright"]["block"]["resources"],
+			config ["playwright"]["block"]["hosts"],
+			config ["playwright"]["block"]["report"],
+		)
+
+		# Every X login we scrape as, each in its own browser context
+		sessions = []
+		for login in twitter_logins (config):
+			# If no previous browser context state, create one
+			if not os.path.isfile (login ["state"]):
+				if os.path.dirname (login ["state"]) != "":
+					os.makedirs (os.path.dirname (login ["state"]), exist_ok = True)
+				# Create a new context
+				context = await browser.new_context (
+					# Viewport information isn't strictly needed here, but for
+					# the sake of uniformity it's included
+					viewport = {
+						"width": config ["playwright"]["viewport"]["width"],
+						"height": config ["playwright"]["viewport"]["height"],
+					},
+				)
+				# Save the context state
+				await context.storage_state (path = login ["state"])
+				# Close the context... we'll re-open using the saved state below
+				await context.close ()
+
+			# Open a browser context using the previously saved state so we
+			# don't always have to log into Twitter
 			context = await browser.new_context (
-				# Viewport information isn't strictly needed here, but for the
-				# sake of uniformity it's included
+				# Our previously saved state
+				storage_state = login ["state"],
+				# Viewport size dictates how many tweets are loaded... mainly
+				# the height, but width does play a role at smaller dimensions
 				viewport = {
 					"width": config ["playwright"]["viewport"]["width"],
 					"height": config ["playwright"]["viewport"]["height"],
 				},
 			)
-			# Save the context state
-			await context.storage_state (path = "state.json")
-			# Close the context... we'll re-open using the saved state below
-			await context.close ()
-
-		# Open a browser context using the previously saved state so we don't
-		# always have to log into Twitter
-		context = await browser.new_context (
-			# Our previously saved state
-			storage_state = "state.json",
-			# Viewport size dictates how many tweets are loaded... mainly the
-			# height, but width does play a role at smaller dimensions
-			viewport = {
-				"width": config ["playwright"]["viewport"]["width"],
-				"height": config ["playwright"]["viewport"]["height"],
-			},
-		)
+
+			await blocker.attach (context)
+
+			# Long-lived pages to scrape with, which also caps how many
+			# scrapes run at the same time for this login
+			pages = PagePool (context, config ["playwright"]["concurrency"])
+			await pages.warm ()
+
+			# The X login itself, which remembers whether it's logged in
+			sessions.append (TwitterSession (
+				context,
+				pages,
+				login ["username"],
+				login ["password"],
+				login ["state"],
+				config ["twitter"]["delays"]["login_check"],
+				blocker,
+				config ["twitter"]["delays"]["rate_limit"],
+			))
+
+		# Watched usernames are spread across the logins
+		session = TwitterSessionRing (sessions)
+
+		# Checks still in progress, by username, so a slow one doesn't hold
+		# up the deadlines of everything else
+		running = {}
+
+		def check_done (username:str, task:asyncio.Task):
+			running.pop (username, None)
+			# Complain to the console about checks that blew up
+			if task.cancelled () is False and task.exception () is not None:
+				print (f"Error: Failed to check {username}: {task.exception ()!r}", file = sys.stderr)
 
 		# Here we go...
 		while True:
-			# Grab a list of webhooks+accounts ready to be checked
-			to_check = accounts_ready_to_check (config)
-
-			# If we don't have any accounts to check we're going to sleep for a
-			# short while before checking again
-			if len (to_check) == 0:
-				# Async sleepy time
-				await asyncio.sleep (config ["twitter"]["delays"]["no_check"])
+			# Sleep until the next username is due, and grab everything that is
+			due = await scheduler.wait (config ["twitter"]["delays"]["no_check"])
+
+			# Skip anything whose previous check hasn't finished yet, it'll be
+			# picked up again at its next deadline
+			due = [(username, subscriptions) for username, subscriptions in due if username not in running]
+
+			# Nothing to check, so back to sleep
+			if len (due) == 0:
 				# Restart the loop
 				continue
 
-			# We have accounts to check, so first verify we're still logged in
-			if await twitter_is_logged_in (context) is False:
-				# We're not logged in... we'll try logging in
-				if await twitter_login (
-					context,
-					config ["twitter"]["login"]["username"],
-					config ["twitter"]["login"]["password"]
-				) is False:
-					# Login failed! Complain to the console
-					print ("Error: Failed to log into Twitter!", file = sys.stderr)
-					# Async sleepy time so we don't spin hard on trying to login
-					await asyncio.sleep (config ["twitter"]["delays"]["failed_login"])
-					# Restart the loop
-					continue
-				else:
-					# We're logged in, so save state so we save the cookies
-					await context.storage_state (path = "state.json")
-
-			for watch_index, username in to_check:
-				# Save us a bunch of typing by setting some variables to long
-				# structure paths
-				webhook = config ["watches"][watch_index]["webhook"]
-				history_mode = config ["watches"][watch_index]["history"]
-				settings = config ["watches"][watch_index]["accounts"][username]
-
-				# Check for a history entry (not necessarily history) for this
-				# username under this webhook
-				if await history_has (webhook, username, mode = "by-account") is False:
-					# No history entry? It's new! Grab a BUNCH of posts because
-					# sometimes ordering changes to bring old posts to the top
-					tweets = await twitter_get_user_tweets (context, username, minimum = config ["twitter"]["history_length"])
-					# Time to "check" the tweets
-					for tweet in tweets:
-						# Add to history because we're building out a new
-						# history
-						await history_add (webhook, username, tweet ["id"], mode = history_mode)
+			# We have accounts to check, so first verify we're still logged in.
+			# This is usually answered from the cache without loading a page
+			if await session.ready (config ["twitter"]["delays"]["failed_login"]) is False:
+				# No login is usable! Complain to the console
+				print ("Error: Failed to log into Twitter!", file = sys.stderr)
+				# Async sleepy time so we don't spin hard on trying to login
+				await asyncio.sleep (config ["twitter"]["delays"]["failed_login"])
+				# Restart the loop
+				continue
 
-				else:
-					# Just a normal check... Load the user's tweets
-					tweets = await twitter_get_user_tweets (context, username, minimum = config ["twitter"]["check_length"])
-
-					# Time to check the tweets
-					for tweet in tweets:
-						# Don't send a tweet if we've already sent it
-						if await history_has (webhook, username, tweet ["id"], mode = history_mode) is True:
-							# Next tweet please
-							continue
-
-						# Is this something we're supposed to send to the webhook?
-						if tweet_sendable (settings, tweet) is True:
-							# Generate the Discord embed object for the tweet
-							embed = await tweet_to_discord_embed (tweet, config)
-							# Deliver the embed object to the webhook
-							await discord_send_webhook (webhook, embed)
-
-						# Add to history regardless of whether or not we
-						# send it
-						await history_add (webhook, username, tweet ["id"], mode = history_mode)
+			# Check the accounts side by side in the background, with the
+			# number of pages scraping at once capped by the size of the page
+			# pool
+			for username, subscriptions in due:
+				task = asyncio.create_task (check_account (session, videos, delivery, config, history, subscriptions))
+				task.add_done_callback (lambda task, username = username: check_done (username, task))
+				running [username] = task
 
 		# We probably won't get here, but we'll handle closing of the browser in
 		# case we somehow do
+		for twitter_session in sessions:
+			await twitter_session.pages.close ()
 		await browser.close ()
 
+	await delivery.join ()
+	await delivery.close ()
+	await http.close ()
+	history.close ()
+
 # ==============================================================================
 
 if __name__ == "__main__":
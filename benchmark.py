@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks for the hot paths in app.py
+#
+# Usage: ./benchmark.py [name ...]
+
+import glob
+import json
+import os.path
+import sys
+import time
+import tracemalloc
+
+import app
+
+# ==============================================================================
+
+class NullHistoryBackend:
+	def load (self) -> list[tuple]:
+		return []
+
+	def append (self, entries:list[tuple]):
+		pass
+
+	def close (self):
+		pass
+
+def timed (function, iterations:int) -> float:
+	# Returns the average time of a call in microseconds
+	start = time.perf_counter ()
+	for _ in range (iterations):
+		function ()
+	return (time.perf_counter () - start) / iterations * 1000000
+
+# ==============================================================================
+
+def benchmark_history ():
+	webhook = "https://discord.com/api/webhooks/benchmark"
+	accounts = 50
+	iterations = 100000
+
+	print (f"{'entries':>10} {'by-account hit':>16} {'by-author hit':>15} {'by-author miss':>16}")
+
+	for size in (1000, 10000, 100000, 1000000):
+		history = app.History (NullHistoryBackend ())
+		for index in range (size):
+			history.index (webhook, f"user{index % accounts}", f"user{index % accounts}/{index}")
+
+		last = size - 1
+		username = f"user{last % accounts}"
+		id = f"/{username}/status/{last}"
+
+		by_account = timed (lambda: history.has (webhook, username, id, mode = "by-account"), iterations)
+		by_author = timed (lambda: history.has (webhook, username, id, mode = "by-author"), iterations)
+		by_author_miss = timed (lambda: history.has (webhook, username, "/nobody/status/0", mode = "by-author"), iterations)
+
+		print (f"{size:>10} {by_account:>14.3f}us {by_author:>13.3f}us {by_author_miss:>14.3f}us")
+
+# ==============================================================================
+
+FIXTURES_DIR = os.path.join (os.path.dirname (os.path.abspath (__file__)), "fixtures")
+
+def load_fixtures () -> list[tuple]:
+	# (name, article HTML, expected tweet dict) for every saved article
+	fixtures = []
+	for path in sorted (glob.glob (os.path.join (FIXTURES_DIR, "*.html"))):
+		with open (path, "r", encoding = "utf-8") as fh:
+			html = fh.read ()
+		with open (path [:-len (".html")] + ".json", "r", encoding = "utf-8") as fh:
+			expected = json.load (fh)
+		fixtures.append ((os.path.basename (path), html, expected))
+	return fixtures
+
+def benchmark_parse ():
+	iterations = 200
+	fixtures = load_fixtures ()
+
+	# Make sure the parser still agrees with the saved output first
+	for name, html, expected in fixtures:
+		if app.twitter_parse_tweet_html (html) != expected:
+			print (f"Error: Parsed {name} doesn't match the saved output", file = sys.stderr)
+
+	start = time.perf_counter ()
+	for _ in range (iterations):
+		for name, html, expected in fixtures:
+			app.twitter_parse_tweet_html (html)
+	elapsed = time.perf_counter () - start
+
+	print (f"{iterations * len (fixtures) / elapsed:.0f} tweets/sec")
+
+	# Time building the document and each field separately
+	fields = {"document": timed (lambda: [app.twitter_html_article (html) for name, html, expected in fixtures], iterations) / len (fixtures)}
+	articles = [app.twitter_html_article (html) for name, html, expected in fixtures]
+	for field, parse in app.TWITTER_HTML_FIELDS.items ():
+		fields [field] = timed (lambda: [parse (article, app.twitter_new_tweet ()) for article in articles], iterations) / len (fixtures)
+
+	for field, elapsed in fields.items ():
+		print (f"{field:>10} {elapsed:>10.1f}us")
+
+# ==============================================================================
+
+def synthetic_tweet (index:int, parts:int) -> dict:
+	# A post with long richtext full of markup that needs escaping, some
+	# links and a few images
+	tweet = app.twitter_new_tweet ()
+	tweet ["id"] = f"/benchmark/status/{index}"
+	tweet ["timestamp"] = "2024-01-01T00:00:00.000Z"
+	tweet ["author"]["username"] = "benchmark"
+	tweet ["author"]["name"] = "Benchmark"
+	tweet ["author"]["avatar"] = "https://pbs.twimg.com/profile_images/0/benchmark_normal.jpg"
+
+	for part in range (parts):
+		if part % 3 == 0:
+			tweet ["content"]["richtext"].append ({"url": f"https://twitter.com/hashtag/tag{part}", "text": f"#tag_{part}"})
+		else:
+			tweet ["content"]["richtext"].append ({"url": None, "text": f"- some *text* with (markup) and [brackets] ~{part}~ `code` "})
+	tweet ["content"]["text"] = "".join (part ["text"] for part in tweet ["content"]["richtext"])
+
+	tweet ["flags"]["has_image"] = True
+	for image in range (3):
+		tweet ["content"]["media"].append ({"type": "image", "image": f"https://pbs.twimg.com/media/{index}-{image}?format=jpg&name=small"})
+
+	return tweet
+
+def benchmark_embed ():
+	iterations = 20
+	config = app.config_merge_defaults ({"discord": {"embed": {"username": "X", "avatar_url": None, "flags": 4096, "color": 0}}}, app.CONFIG_DEFAULTS)
+	template = app.discord_embed_template (config, {})
+
+	print (f"{'parts':>10} {'embeds/sec':>12} {'per part':>10}")
+
+	for parts in (10, 50, 200):
+		tweets = [app.Tweet.from_dict (synthetic_tweet (index, parts)) for index in range (1000)]
+
+		start = time.perf_counter ()
+		for _ in range (iterations):
+			for tweet in tweets:
+				app.discord_render_embed (tweet, template)
+		elapsed = time.perf_counter () - start
+
+		rate = iterations * len (tweets) / elapsed
+		print (f"{parts:>10} {rate:>12.0f} {1000000 / rate / parts:>8.3f}us")
+
+# ==============================================================================
+
+def benchmark_tweet ():
+	count = 10000
+	iterations = 20
+
+	# The records have to round trip through the dict form the parsers use
+	for name, html, expected in load_fixtures ():
+		if app.Tweet.from_dict (expected).to_dict () != expected:
+			print (f"Error: {name} doesn't survive Tweet.from_dict/to_dict", file = sys.stderr)
+
+	# Memory held by a backfill's worth of posts in each form
+	sources = [synthetic_tweet (index, 10) for index in range (count)]
+	serialized = json.dumps (sources)
+	for label, build in (("dict", lambda: json.loads (serialized)), ("Tweet", lambda: [app.Tweet.from_dict (source) for source in json.loads (serialized)])):
+		tracemalloc.start ()
+		tweets = build ()
+		size, peak = tracemalloc.get_traced_memory ()
+		tracemalloc.stop ()
+		print (f"{label:>10} {size / count:>10.0f} bytes/tweet")
+		del tweets
+
+	# Filtering a backfill against every combination of account settings
+	tweets = [app.Tweet.from_dict (source) for source in sources]
+	for index, tweet in enumerate (tweets):
+		tweet.flags = index % 16
+	options = ("posts", "reposts", "pinned", "with-images", "with-videos", "without-media")
+	settings = [app.tweet_filter_mask ({option: mask & (1 << bit) != 0 for bit, option in enumerate (options)}) for mask in range (64)]
+
+	start = time.perf_counter ()
+	for _ in range (iterations):
+		for account in settings:
+			for tweet in tweets:
+				app.tweet_sendable (account, tweet)
+	elapsed = time.perf_counter () - start
+
+	print (f"{'filter':>10} {iterations * len (settings) * len (tweets) / elapsed:>10.0f} tweets/sec")
+
+# ==============================================================================
+
+BENCHMARKS = {
+	"history": benchmark_history,
+	"parse": benchmark_parse,
+	"embed": benchmark_embed,
+	"tweet": benchmark_tweet,
+}
+
+if __name__ == "__main__":
+	names = sys.argv [1:] or list (BENCHMARKS.keys ())
+	for name in names:
+		if name not in BENCHMARKS:
+			print (f"Error: Unknown benchmark: {name}", file = sys.stderr)
+			sys.exit (1)
+
+		print (f"== {name}")
+		BENCHMARKS [name]()
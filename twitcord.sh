@@ -13,20 +13,43 @@ if [ ! -e "${__DIR__}/history.json" ]; then
 	echo "{}" > "${__DIR__}/history.json"
 fi
 
+if [ ! -e "${__DIR__}/history.log" ]; then
+	touch "${__DIR__}/history.log"
+fi
+
+if [ ! -e "${__DIR__}/outbox.log" ]; then
+	touch "${__DIR__}/outbox.log"
+fi
+
 if [ ! -e "${__DIR__}/state.json" ]; then
 	echo "{}" > "${__DIR__}/state.json"
 fi
 
+# Browser state for every login after the first
+mkdir -p "${__DIR__}/state"
+
+# History stores other than history.log and history.json (see history.path)
+mkdir -p "${__DIR__}/data"
+
 if [ ! -e "${__DIR__}/config.yaml" ]; then
 	echo "Error: Missing config.yaml" 1>&2
 	exit 1
 fi
 
+# config.yaml is mounted as a single file, so the container keeps seeing the
+# original if an editor saves by writing a new file and renaming it over the
+# old one. For the reload option to pick up changes, edit it in place (e.g.
+# with `vim -c 'set backupcopy=yes'` or `cat new.yaml > config.yaml`) or
+# restart the container
 exec docker run \
 	-d \
 	--rm \
 	-v "${__DIR__}/config.yaml:/app/config.yaml:ro" \
 	-v "${__DIR__}/state.json:/app/state.json" \
+	-v "${__DIR__}/state:/app/state" \
+	-v "${__DIR__}/data:/app/data" \
 	-v "${__DIR__}/history.json:/app/history.json" \
+	-v "${__DIR__}/history.log:/app/history.log" \
+	-v "${__DIR__}/outbox.log:/app/outbox.log" \
 	--name twitcord \
 	twitcord:dev